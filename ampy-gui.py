@@ -6,15 +6,154 @@ import gi
 gi.require_version('Gtk', '3.0')
 from gi.repository import Gtk, GObject, GdkPixbuf
 from gi.repository import Gdk, GLib
-from ampy.pyboard import PyboardError
+from ampy.pyboard import Pyboard, PyboardError
 import subprocess
+import ast
+import io
+import codecs
+import stat
+import hashlib
+import binascii
+import time
+import datetime
+import json
+import bisect
+import fnmatch
+import re
+import tarfile
 import serial.tools.list_ports
+from serial.urlhandler.protocol_socket import Serial as SocketSerial
+import socket
 from enum import Enum
-from threading import Thread, Event
+from threading import Thread, Event, Lock, RLock, current_thread, main_thread
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import glob
+import functools
+from contextlib import contextmanager
+from abc import ABC, abstractmethod
 
 # TODO: wildcard .* & configurable over commmand line
 ignore_files = [".DS_Store", ".git", ".idea"]	# ignore these files when listing files in a directory
+PART_SUFFIX = ".ampygui-part"	# unfinished downloads, and uploads on the device (_PART in the helper), are hidden
+
+HELPER_FILE = "/ampygui_helper.py"				# where util/ampygui_helper.py is installed on the remote device
+HELPER_IMPORT = "import ampygui_helper as _h;_h."	# prefix of every one-line helper call
+BACKUP_MANIFEST = "ampygui-backup.json"		# last member of a backup archive: device ID, directories, file sizes and sha256
+TRANSFER_CHUNK = 512							# bytes per acknowledged upload chunk, the size of _buf in the helper
+DELTA_MIN_SIZE = 16384							# files this large are patched block by block when they exist on the device
+PROFILE_FILE = "/.ampygui_profile.py"			# where a profiled script is uploaded to, removed after the run
+
+# Runs a profiled script as a single command: samples (microseconds since start, gc.mem_free(), gc.mem_alloc()) between
+# \x1e and \x1f, from a periodic machine.Timer where the port has one, then, even if the script raised, a last sample and
+# micropython.mem_info() between \x1eM\x1f and \x1e/M\x1f, see ProfileStream. The timer never outlives the command. The
+# script is read from the file it was uploaded to, so its source is garbage before the first sample, and compiled under its
+# own name, so its line numbers are unchanged
+PROFILE_RUN = """import gc, time
+def _prof(_=None):
+ try:
+  print('\\x1e%d,%d,%d\\x1f' % (time.ticks_diff(time.ticks_us(), _prof_t0), gc.mem_free(), gc.mem_alloc()), end='')
+ except Exception:
+  pass
+_prof_f = open({1})
+_prof_code = _prof_f.read()
+_prof_f.close()
+try:
+ _prof_code = compile(_prof_code, {2}, 'exec')
+except NameError:
+ pass
+_prof_f = None
+gc.collect()
+_prof_t0 = time.ticks_us()
+_prof_timer = None
+try:
+ from machine import Timer
+ try:
+  _prof_timer = Timer(-1)
+ except Exception:
+  _prof_timer = Timer(0)
+ _prof_timer.init(period={0}, mode=Timer.PERIODIC, callback=_prof)
+except Exception:
+ _prof_timer = None
+_prof()
+try:
+ exec(_prof_code, {{'__name__': '__main__'}})
+finally:
+ if _prof_timer is not None:
+  _prof_timer.deinit()
+ _prof()
+ try:
+  import micropython
+  print('\\x1eM\\x1f', end='')
+  micropython.mem_info()
+  print('\\x1e/M\\x1f', end='')
+ except Exception:
+  pass
+ try:
+  import os
+  os.remove({1})
+ except OSError:
+  pass"""
+
+# Defines _bench(f, warmup, repeat): calls f warmup times, then times repeat calls with time.ticks_us(), each after a
+# gc.collect() and with the collector off, and prints the microseconds as a list between \x1e and \x1f, so it can be told
+# from the output of f, see bench_reply()
+BENCH_HARNESS = """import gc, time
+def _bench(f, warmup, repeat):
+ for i in range(warmup):
+  f()
+ times = []
+ for i in range(repeat):
+  gc.collect()
+  gc.disable()
+  try:
+   t = time.ticks_us()
+   f()
+   times.append(time.ticks_diff(time.ticks_us(), t))
+  finally:
+   gc.enable()
+ print('\\x1e%r\\x1f' % (times,))"""
+
+# Bytes the REPL console sends for special keys, by Gdk key name
+REPL_KEYS = {"Return": b'\r', "KP_Enter": b'\r', "BackSpace": b'\x7f', "Tab": b'\t', "Up": b'\x1b[A', "Down": b'\x1b[B',
+			 "Right": b'\x1b[C', "Left": b'\x1b[D', "Home": b'\x1b[H', "End": b'\x1b[F', "Delete": b'\x1b[3~'}
+
+# Switches the REPL UART of the device to another baud rate. Boards with native USB (CDC) ignore the baud rate altogether.
+BAUD_SWITCH = """import sys
+if sys.platform in ('esp32', 'esp8266'):
+ import machine, time
+ print('SWITCH')
+ time.sleep_ms(20)
+ machine.UART(0, {})
+else:
+ print('FIXED')"""
+
+# What the helper's echo() does, for the link probe without the helper
+LINK_ECHO = """import hashlib, binascii
+_d = {!r}
+print(repr((binascii.hexlify(hashlib.sha256(_d).digest()).decode(), _d)))"""
+
+# Drops the modules of the given .py files from sys.modules, named after each sys.path entry they are below
+WATCH_REIMPORT = """import sys, os
+for _p in {!r}:
+ for _d in sys.path:
+  _d = (_d or os.getcwd()).rstrip('/') + '/'
+  if _p.startswith(_d):
+   _m = _p[len(_d):-3].replace('/', '.')
+   sys.modules.pop(_m[:-9] if _m.endswith('.__init__') else _m, None)"""
+
+# Prints (board, implementation name, version, hex machine.unique_id() or None) for the port auto-detection
+BOARD_PROBE = """import sys
+try:
+ import machine, binascii
+ _uid = binascii.hexlify(machine.unique_id()).decode()
+except Exception:
+ _uid = None
+_impl = sys.implementation
+print(repr((getattr(_impl, '_machine', sys.platform), _impl.name, '.'.join(str(n) for n in _impl.version[:3]), _uid)))"""
+
+# The REPL banner, e.g. "MicroPython v1.22.2 on 2024-02-22; Generic ESP32 module with ESP32"
+BANNER = re.compile(r'^(.*?) (v?\d\S*) on (\S+); (.+?)\s*$', re.MULTILINE)
 
 class MsgType(Enum):
 	""" Different message type options for the terminal window, and the corresponding color of the terminal text.
@@ -23,6 +162,1605 @@ class MsgType(Enum):
 	WARNING = "#eb9f4d"
 	ERROR = "#f5805f"
 
+def device_error_text(ex):
+	""" Returns a readable message for an exception raised while talking to the remote device.
+	"""
+	if isinstance(ex, PyboardError) and len(ex.args) == 3 and isinstance(ex.args[2], bytes):
+		# ('exception', stdout, stderr): the last line of the device traceback holds the actual error
+		lines = ex.args[2].decode("UTF-8", "replace").strip().splitlines()
+		if lines:
+			return lines[-1]
+	return " ".join(str(arg) for arg in ex.args) or type(ex).__name__
+
+class Transport(ABC):
+	""" How the remote device is reached. open() returns a pyserial style stream (read(), write(), inWaiting(),
+	timeout, baudrate, reset_input_buffer(), close()) for ampy's Pyboard and DeviceSession to drive.
+	"""
+	name = None
+	baud = False	# whether the baud rate of the link can be changed
+	ampy = False	# whether the ampy command line can reach the device through this transport
+
+	@abstractmethod
+	def handles(self, port):
+		pass
+
+	@abstractmethod
+	def open(self, port, baud):
+		pass
+
+	def probe(self, port):
+		""" Raises serial.SerialException if the device can't be reached.
+		"""
+		self.open(port, 115200).close()
+
+	def hard_reset(self, port, baud):
+		""" Resets the board without the help of its REPL, returns False if the transport can't.
+		"""
+		return False
+
+class SerialTransport(Transport):
+	""" A local serial port, e.g. /dev/ttyUSB0 or COM3.
+	"""
+	name = "serial"
+	baud = True
+	ampy = True
+
+	def handles(self, port):
+		return True
+
+	def open(self, port, baud):
+		return serial.Serial(port, baudrate=baud, interCharTimeout=1)
+
+	def probe(self, port):
+		serial.Serial(port=port).close()
+
+	def hard_reset(self, port, baud):
+		# Pulses EN/RESET through the DTR/RTS auto-reset circuit most boards have
+		stream = self.open(port, baud)
+		stream.dtr = False
+		stream.rts = True
+		time.sleep(0.1)
+		stream.rts = False
+		stream.close()
+		return True
+
+class SocketStream(SocketSerial):
+	""" pyserial's socket:// port, with Nagle's algorithm off since the raw REPL trades many small packets, and with
+	an in_waiting that counts the received bytes (pyserial only reports 0 or 1), so output is read in bulk.
+	"""
+
+	def open(self):
+		super().open()
+		self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+	@property
+	def in_waiting(self):
+		if not self.is_open:
+			raise serial.PortNotOpenError()
+		try:
+			return len(self._socket.recv(65536, socket.MSG_PEEK))
+		except BlockingIOError:
+			return 0
+
+class SocketTransport(Transport):
+	""" A raw TCP stream, socket://host:port: e.g. the unix port of MicroPython or an emulator behind socat, or a
+	WebREPL bridge that forwards the REPL bytes unchanged.
+	"""
+	name = "socket"
+
+	def handles(self, port):
+		return port.startswith("socket://")
+
+	def open(self, port, baud):
+		return SocketStream(port, baudrate=baud, timeout=1)
+
+TRANSPORTS = [SocketTransport(), SerialTransport()]		# the first one that handles a port is used
+
+def transport_for(port):
+	for transport in TRANSPORTS:
+		if transport.handles(port):
+			return transport
+
+class TransportPyboard(Pyboard):
+	""" ampy's Pyboard on a stream opened by a Transport, instead of the serial port it would open itself.
+	"""
+
+	def __init__(self, stream, rawdelay=0, on_flush=None):
+		self.rawdelay = rawdelay
+		self.serial = stream
+		self.on_flush = on_flush	# gets what the device printed before the raw REPL was entered, else it is dropped
+
+	def enter_raw_repl(self, reboot=True):
+		""" Pyboard.enter_raw_repl(), with the raw delay of this board instead of the module-wide one that
+		Pyboard.__init__ sets, which sessions on other ports would race for. Without reboot, the device is not soft
+		reset, so it keeps its imported modules and globals, and the '>' prompt is already read on return.
+		"""
+		if self.rawdelay > 0:
+			time.sleep(self.rawdelay)
+		# Ctrl-C twice: interrupt any running program, then flush the input
+		self.serial.write(b'\r\x03')
+		time.sleep(0.1)
+		self.serial.write(b'\x03')
+		time.sleep(0.1)
+		n = self.serial.inWaiting()
+		while n > 0:
+			data = self.serial.read(n)
+			if self.on_flush is not None:
+				self.on_flush(data)
+			n = self.serial.inWaiting()
+		for retry in range(5):
+			self.serial.write(b'\r\x01')
+			data = self.read_until(1, b'raw REPL; CTRL-B to exit\r\n>')
+			if data.endswith(b'raw REPL; CTRL-B to exit\r\n>'):
+				break
+			if retry >= 4:
+				raise PyboardError('could not enter raw repl')
+			time.sleep(0.2)
+		if not reboot:
+			return
+		# Ctrl-D: soft reset, then interrupt main.py like ampy does
+		self.serial.write(b'\x04')
+		data = self.read_until(1, b'soft reboot\r\n')
+		if not data.endswith(b'soft reboot\r\n'):
+			raise PyboardError('could not enter raw repl')
+		time.sleep(0.5)
+		self.serial.write(b'\x03')
+		time.sleep(0.1)
+		self.serial.write(b'\x03')
+		data = self.read_until(1, b'raw REPL; CTRL-B to exit\r\n')
+		if not data.endswith(b'raw REPL; CTRL-B to exit\r\n'):
+			raise PyboardError('could not enter raw repl')
+
+class DeviceTimeout(PyboardError):
+	""" A device operation passed its deadline. The device was interrupted before this was raised.
+	"""
+
+class DeviceCancelled(PyboardError):
+	""" A running command was interrupted because the session's cancel() asked for it.
+	"""
+
+class HelperUnavailable(PyboardError):
+	""" The device helper could not be installed. It was reported, and helper_enabled() is False from now on, so the
+	operation can be retried with ampy.
+	"""
+
+class TimeoutStats:
+	""" The device timeouts of this run, by kind of operation and by what it took to recover. Transfers that stall
+	after data started flowing point at the link (cable, baud rate), silent scripts point at the scripts.
+	"""
+
+	TRANSFERS = ("cat", "recv", "unpack", "get", "put")	# helper calls and ampy commands that move file contents
+	SCRIPTS = ("script", "run")
+
+	def __init__(self):
+		self.timeouts = []		# (operation, seconds, bytes received, recovery)
+
+	def record(self, operation, seconds, received, recovery):
+		self.timeouts.append((operation, seconds, received, recovery))
+
+	def summary(self):
+		transfers = [t for t in self.timeouts if t[0] in self.TRANSFERS]
+		scripts = [t for t in self.timeouts if t[0] in self.SCRIPTS]
+		recoveries = {}
+		for operation, seconds, received, recovery in self.timeouts:
+			recoveries[recovery] = recoveries.get(recovery, 0) + 1
+		return "{} timeout(s) so far: {} in transfers ({} stalled mid-stream), {} in scripts, {} in other commands; " \
+			   "recovered by {}".format(len(self.timeouts), len(transfers), sum(1 for t in transfers if t[2]),
+										len(scripts), len(self.timeouts) - len(transfers) - len(scripts),
+										", ".join("{} {}".format(n, recovery) for recovery, n in sorted(recoveries.items())))
+
+class Tracer:
+	""" Records timed spans in Chrome trace event format, for --trace. The file opens in chrome://tracing or
+	ui.perfetto.dev. Does nothing until enabled.
+	"""
+
+	def __init__(self):
+		self.enabled = False
+		self.events = []
+		self.threads = set()
+		self.lock = Lock()
+		self.start = time.perf_counter()
+
+	def now(self):
+		return (time.perf_counter() - self.start) * 1e6		# trace timestamps are in microseconds
+
+	def add(self, event):
+		tid = current_thread().ident
+		event.update(pid=os.getpid(), tid=tid)
+		with self.lock:
+			if tid not in self.threads:
+				self.threads.add(tid)
+				self.events.append({"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid,
+									"args": {"name": current_thread().name}})
+			self.events.append(event)
+
+	@contextmanager
+	def span(self, name, cat, **args):
+		""" Traces the body of the with statement. Yields the event, so its name and args can be filled in later.
+		"""
+		event = {"name": name, "cat": cat, "ph": "X", "args": args}
+		if not self.enabled:
+			yield event
+			return
+		event["ts"] = self.now()
+		try:
+			yield event
+		finally:
+			event["dur"] = self.now() - event["ts"]
+			self.add(event)
+
+	def complete(self, name, cat, started, **args):
+		""" Traces a span that started at started (a now() timestamp) and ends now.
+		"""
+		if self.enabled:
+			self.add({"name": name, "cat": cat, "ph": "X", "ts": started, "dur": self.now() - started, "args": args})
+
+	def instant(self, name, cat, **args):
+		if self.enabled:
+			self.add({"name": name, "cat": cat, "ph": "i", "s": "p", "ts": self.now(), "args": args})
+
+	def write(self, path):
+		with self.lock:
+			events = list(self.events)
+		with open(path, "w") as f:
+			json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+tracer = Tracer()
+
+def traced(handler):
+	""" Traces a GTK signal handler with --trace.
+	"""
+	@functools.wraps(handler)
+	def wrapper(*args, **kwargs):
+		with tracer.span(handler.__name__, "gtk"):
+			return handler(*args, **kwargs)
+	return wrapper
+
+class DeviceSession:
+	""" A single raw REPL session on the remote device. Several commands can be executed over one port open and raw REPL
+	entry, instead of spawning an ampy subprocess for every command.
+	"""
+
+	def __init__(self, port, baud, delay, link_baud=None, lock=None, timeout=10, min_rate=1000, on_timeout=None,
+				 reboot=True):
+		self.port = port
+		self.transport = transport_for(port)
+		self.lock = lock			# held for the lifetime of the session when given
+		self.baud = int(baud)
+		self.delay = float(delay)
+		self.link_baud = int(link_baud) if link_baud else None	# faster rate to switch to once the raw REPL is entered
+		self.link_failed = False
+		self.prompt_ready = False	# whether the '>' prompt of the raw REPL was already read
+		self.pyboard = None
+		self.timeout = timeout		# seconds a command may go without any progress
+		self.min_rate = min_rate	# bytes/s a command must move on average, its deadline grows with the data it moves
+		self.on_timeout = on_timeout	# called with (operation, seconds, bytes received, recovery) before DeviceTimeout
+		self.operation = None		# the command being executed, its start and how many bytes it moved
+		self.started = 0
+		self.sent = 0
+		self.received = 0
+		self.opened = 0				# tracer timestamp of open()
+		self.cancel = None			# when set, receive() interrupts the command as soon as cancel() returns True
+		self.reboot = reboot		# whether entering the raw REPL soft resets the device, like ampy does
+		self.raw_stdin = False		# whether the running command reads raw stdin, with Ctrl-C turned off
+		self.borrowed = False		# whether the port is the one the lock's console keeps open, see ReplConsole.lend()
+		self.helper_id = None		# device ID once AppWindow.ensure_helper() checked the helper in this session
+
+	def __enter__(self):
+		self.open()
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+	def open(self):
+		self.opened = tracer.now()
+		if self.lock is not None:
+			with tracer.span("lock wait", "session"):
+				self.lock.acquire()
+		try:
+			console = self.lock.console if self.lock is not None else None
+			stream = console.lend(self.port, self.baud) if console is not None else None
+			self.borrowed = stream is not None
+			if self.borrowed:
+				# What the device printed up to the interrupt still goes to the console
+				self.pyboard = TransportPyboard(stream, self.delay, console.on_output)
+			else:
+				with tracer.span("port open", "session", port=self.port):
+					self.pyboard = TransportPyboard(self.transport.open(self.port, self.baud), self.delay)
+		except BaseException:
+			if self.lock is not None:
+				self.lock.release()
+			raise
+		try:
+			self.pyboard.serial.timeout = 1		# never block forever on a silent device
+			with tracer.span("raw REPL entry", "session"):
+				self.pyboard.enter_raw_repl(self.reboot)
+			self.prompt_ready = not self.reboot
+			if self.link_baud and self.link_baud != self.baud and self.transport.baud:
+				with tracer.span("baud switch", "session", baud=self.link_baud):
+					self.link_failed = not self.switch_baud(self.link_baud)
+		except BaseException:
+			if not self.borrowed:
+				self.pyboard.close()
+			self.pyboard = None
+			if self.lock is not None:
+				self.lock.release()
+			raise
+
+	def close(self):
+		if self.pyboard is None:
+			return
+		try:
+			if self.pyboard.serial.baudrate != self.baud:
+				# Leave the device at the rate the next session (or ampy) will open it with
+				self.switch_baud(self.baud)
+			self.pyboard.exit_raw_repl()
+		except (PyboardError, serial.SerialException):
+			pass
+		if not self.borrowed:
+			self.pyboard.close()
+		self.pyboard = None
+		if self.lock is not None:
+			self.lock.release()
+		tracer.complete("session", "session", self.opened, port=self.port)
+
+	def switch_baud(self, rate):
+		""" Switches the device REPL UART and the host port to rate. Returns False, with the session recovered at its
+		original baud rate, if the link does not come back up at the new rate.
+		"""
+		try:
+			self.send(BAUD_SWITCH.format(rate))
+			reply = self.pyboard.read_until(1, b'\r\n', timeout=2)
+			if reply.endswith(b'FIXED\r\n'):
+				self.receive(timeout=2)
+				self.pyboard.serial.baudrate = rate
+				return True
+			if reply.endswith(b'SWITCH\r\n'):
+				time.sleep(0.05)
+				self.pyboard.serial.baudrate = rate
+				if self.resync():
+					return True
+		except PyboardError:
+			pass
+		self.recover()
+		return False
+
+	def resync(self):
+		""" Finds the raw REPL prompt again after the line was disturbed, e.g. by a baud rate switch.
+		"""
+		self.pyboard.serial.write(b'\r\x03')
+		time.sleep(0.1)
+		self.pyboard.serial.reset_input_buffer()
+		self.pyboard.serial.write(b'\x01')
+		data = self.pyboard.read_until(1, b'raw REPL; CTRL-B to exit\r\n', timeout=1)
+		self.prompt_ready = False
+		return data.endswith(b'raw REPL; CTRL-B to exit\r\n')
+
+	def recover(self, resync=True):
+		""" Hard resets the board through the DTR/RTS auto-reset circuit, which also restores its default REPL baud rate,
+		and re-enters the raw REPL at the original rate. With resync, the raw REPL prompt is looked for first, and the
+		board is only reset if it doesn't show. Raises PyboardError if the device does not come back.
+		"""
+		self.pyboard.serial.baudrate = self.baud
+		if not resync or not self.resync():
+			self.pyboard.serial.dtr = False
+			self.pyboard.serial.rts = True
+			time.sleep(0.1)
+			self.pyboard.serial.rts = False
+			time.sleep(1)
+			try:
+				self.pyboard.enter_raw_repl()
+				self.prompt_ready = False
+			except PyboardError:
+				raise PyboardError("device did not come back at {} baud, power-cycle it".format(self.baud))
+
+	def soft_reset(self):
+		""" Soft resets the device, which clears its imported modules, and re-enters the raw REPL at the rate the
+		session was running at.
+		"""
+		rate = self.pyboard.serial.baudrate
+		if rate != self.baud:
+			self.switch_baud(self.baud)
+		with tracer.span("soft reset", "session"):
+			self.pyboard.enter_raw_repl()
+		self.prompt_ready = False
+		if rate != self.baud:
+			self.link_failed = not self.switch_baud(rate)
+
+	def round_trip(self):
+		""" Returns the seconds an empty command takes.
+		"""
+		start = time.perf_counter()
+		self.exec("pass")
+		return time.perf_counter() - start
+
+	def interrupt(self):
+		""" Stops the running command and gets back to the raw REPL prompt, with Ctrl-C or else through recover().
+		Returns how, raises PyboardError if the device is lost. The helper's transfers that read raw stdin (recv, unpack,
+		patch) turn Ctrl-C off, since it could be part of the data, and would take whatever is sent as more data. They
+		are stopped with a reset through DTR/RTS right away; on boards without that auto-reset circuit, the device is
+		then lost until it is power-cycled.
+		"""
+		if self.raw_stdin:
+			self.recover(resync=False)
+			return "reset"
+		self.pyboard.serial.write(b'\x03')
+		data = self.pyboard.read_until(1, b'\x04>', timeout=2)
+		if data.endswith(b'\x04>'):
+			self.prompt_ready = True
+			return "Ctrl-C"
+		self.recover()
+		return "reset"
+
+	def check_deadline(self, last_data, timeout):
+		""" Interrupts the running command and raises DeviceTimeout if it made no progress for timeout seconds, or
+		took longer than timeout plus the time its data needs at min_rate.
+		"""
+		now = time.monotonic()
+		if now - last_data <= timeout and now - self.started <= timeout + (self.sent + self.received) / self.min_rate:
+			return
+		try:
+			recovery = self.interrupt()
+		except (PyboardError, serial.SerialException):
+			recovery = "nothing, device lost"
+		if self.on_timeout is not None:
+			self.on_timeout(self.operation, now - self.started, self.received, recovery)
+		raise DeviceTimeout("'{}' timed out after {:.0f}s, stopped by {}".format(self.operation, now - self.started, recovery))
+
+	def send(self, command):
+		""" Sends command to the raw REPL and starts executing it, the output is read with receive().
+		"""
+		if isinstance(command, str):
+			self.operation = command[len(HELPER_IMPORT):].split("(")[0] if command.startswith(HELPER_IMPORT) else "script"
+			command = command.encode("UTF-8")
+		else:
+			self.operation = "script"
+		self.started = time.monotonic()
+		self.sent = len(command)
+		self.received = 0
+		if not self.prompt_ready:
+			data = self.pyboard.read_until(1, b'>')
+			if not data.endswith(b'>'):
+				raise PyboardError('could not enter raw repl')
+		self.prompt_ready = False
+		for i in range(0, len(command), 256):
+			self.pyboard.serial.write(command[i:i + 256])
+			time.sleep(0.01)
+		self.pyboard.serial.write(b'\x04')
+		if self.pyboard.serial.read(2) != b'OK':
+			raise PyboardError('could not exec command')
+
+	def receive(self, timeout=None, consumer=None, pending=b''):
+		""" Reads the output of the command started by send(). stdout is returned, or passed piece by piece to
+		consumer(bytes) as it arrives so it never has to be held in memory. pending is output that was already read from
+		the port. Raises PyboardError if the command raised, DeviceTimeout if it passed its deadline (see
+		check_deadline(), timeout defaults to the session's), DeviceCancelled if cancel() stopped it.
+		"""
+		timeout = timeout or self.timeout
+		out = bytearray()
+		err = bytearray()
+		markers = 0		# the raw REPL ends stdout and stderr with \x04 each
+		port = self.pyboard.serial
+		last_data = time.monotonic()
+		while markers < 2:
+			if self.cancel is not None and self.cancel():
+				self.interrupt()
+				raise DeviceCancelled("'{}' was cancelled".format(self.operation))
+			# Also while output keeps trickling in, which never counts as no progress
+			self.check_deadline(last_data, timeout)
+			data = pending or port.read(port.in_waiting or 1)
+			pending = b''
+			if not data:
+				continue
+			last_data = time.monotonic()
+			self.received += len(data)
+			while data and markers < 2:
+				end = data.find(b'\x04')
+				piece = data if end < 0 else data[:end]
+				if markers == 1:
+					err += piece
+				elif consumer is not None:
+					if piece:
+						consumer(piece)
+				else:
+					out += piece
+				if end < 0:
+					break
+				markers += 1
+				data = data[end + 1:]
+			if markers == 2 and data.startswith(b'>'):
+				self.prompt_ready = True
+		if err:
+			raise PyboardError('exception', bytes(out), bytes(err))
+		return bytes(out)
+
+	def exec(self, command, timeout=None, consumer=None):
+		""" Executes command on the device and returns its stdout (see receive()), raises PyboardError if the command
+		raised.
+		"""
+		with tracer.span("command", "device") as event:
+			with tracer.span("send", "transfer"):
+				self.send(command)
+			event["name"] = self.operation
+			try:
+				with tracer.span("execute", "device"):
+					return self.receive(timeout, consumer)
+			finally:
+				event["args"].update(sent=self.sent, received=self.received)
+
+	def call(self, command, timeout=None):
+		""" Executes command, which prints a single repr() line, and returns the parsed value.
+		"""
+		out = self.exec(command, timeout)
+		try:
+			return ast.literal_eval(out.decode("UTF-8").strip())
+		except (ValueError, SyntaxError):
+			raise PyboardError("unexpected reply from device: {!r}".format(out[:80]))
+
+	def read_file(self, remote_path, f, timeout=None, offset=0):
+		""" Streams a remote file, from offset on, into the binary file object f, through the base64 lines written by
+		the helper's cat(). Only a single line is ever held in memory.
+		"""
+		pending = bytearray()
+		def consume(data):
+			pending.extend(data)
+			end = pending.rfind(b'\n')
+			if end < 0:
+				return
+			for line in pending[:end].split(b'\n'):
+				if line.strip():
+					f.write(binascii.a2b_base64(line))
+			del pending[:end + 1]
+		self.exec(HELPER_IMPORT + "cat({!r},{})".format(remote_path, offset), timeout, consume)
+		if pending.strip():
+			f.write(binascii.a2b_base64(bytes(pending)))
+
+	def write_file(self, remote_path, f, chunk_size=256):
+		""" Writes the binary file object f to remote_path with plain f.write() calls, which works without the helper.
+		"""
+		buf = bytearray(chunk_size)
+		self.exec("f=open({!r},'wb')".format(remote_path))
+		while True:
+			n = f.readinto(buf)
+			if not n:
+				break
+			self.exec("f.write({!r})".format(bytes(buf[:n])))
+		self.exec("f.close()")
+
+	def send_file(self, remote_path, f, size, timeout=None, offset=0):
+		""" Streams the binary file object f, size bytes in all, to remote_path through the helper's recv(), which
+		only renames it into place once complete. With offset, f is positioned there and the device already has the
+		bytes before it (see resume_offset()). Returns False, without having sent anything, if the device cannot read
+		raw data from stdin.
+		"""
+		return self.send_stream(HELPER_IMPORT + "recv({!r},{},{})".format(remote_path, size, offset), f, size - offset,
+								timeout)
+
+	def resume_offset(self, remote_path, f, size):
+		""" Returns how many bytes of an interrupted upload of the binary file object f to remote_path the device
+		already has, 0 if they don't match the start of f. f is left at the start.
+		"""
+		unfinished = self.call(HELPER_IMPORT + "part({!r})".format(remote_path))
+		if unfinished is None or unfinished[0] > size:
+			return 0
+		offset, digest = unfinished
+		h = hashlib.sha256()
+		left = offset
+		while left:
+			block = f.read(min(left, 1 << 16))
+			if not block:
+				break
+			h.update(block)
+			left -= len(block)
+		f.seek(0)
+		return offset if h.hexdigest() == digest else 0
+
+	def block_sums(self, remote_path):
+		""" Returns the truncated sha256 of every TRANSFER_CHUNK block of a remote file (see the helper's sums()), []
+		when it does not exist.
+		"""
+		out = self.exec(HELPER_IMPORT + "sums({!r})".format(remote_path)).decode("ascii").strip()
+		return [out[i:i + 16] for i in range(0, len(out), 16)]
+
+	def send_delta(self, remote_path, f, size, sums, timeout=None):
+		""" Makes remote_path, whose blocks have sums, equal to the size bytes of the binary file object f by only
+		sending the blocks that differ, through the helper's patch(). Returns the number of bytes sent, or False,
+		without having sent anything, if the device cannot read raw data from stdin.
+		"""
+		ranges = []		# [[first block, count], ...] to send
+		block = 0
+		while block * TRANSFER_CHUNK < size:
+			digest = hashlib.sha256(f.read(TRANSFER_CHUNK)).hexdigest()[:16]
+			if block >= len(sums) or sums[block] != digest:
+				if ranges and sum(ranges[-1]) == block:
+					ranges[-1][1] += 1
+				else:
+					ranges.append([block, 1])
+			block += 1
+		if not ranges and len(sums) == block:
+			return 0
+		stream = BlockStream(f, ranges, size)
+		# The device also copies the unchanged blocks, which takes time without any traffic
+		timeout = timeout or self.timeout + size / self.min_rate
+		command = HELPER_IMPORT + "patch({!r},{},{!r})".format(remote_path, size, ranges)
+		return stream.size if self.send_stream(command, stream, stream.size, timeout) else False
+
+	def send_stream(self, command, f, size, timeout=None):
+		""" Starts a helper command that reads size raw bytes from stdin (see _chunks() in the helper) and feeds it
+		from the binary file object f. The data goes out in chunks of TRANSFER_CHUNK bytes that are each sent once the
+		device acknowledges it is ready for them, and is read through a single fixed buffer, so memory use does not
+		depend on the size on either side. Returns the reply of the command, or False, without having sent anything,
+		if the device cannot read raw data from stdin.
+		"""
+		with tracer.span("command", "device") as event:
+			with tracer.span("send", "transfer"):
+				self.send(command)
+			event["name"] = self.operation
+			try:
+				with tracer.span("stream", "transfer", size=size):
+					return self.stream(f, size, timeout)
+			finally:
+				event["args"].update(sent=self.sent, received=self.received)
+
+	def stream(self, f, size, timeout=None):
+		""" Feeds the command started by send_stream(), returns its reply.
+		"""
+		timeout = timeout or self.timeout
+		self.raw_stdin = True
+		try:
+			return self.feed(f, size, timeout)
+		finally:
+			self.raw_stdin = False
+
+	def feed(self, f, size, timeout):
+		buf = bytearray(TRANSFER_CHUNK)
+		mv = memoryview(buf)
+		port = self.pyboard.serial
+		left = size
+		short = False
+		while left:
+			self.check_deadline(time.monotonic(), timeout)
+			ack = port.read(1)
+			last_data = time.monotonic()
+			while not ack:
+				self.check_deadline(last_data, timeout)
+				ack = port.read(1)
+			if ack != b'\x06':
+				# The command finished early: it either raised or reported that it can't read stdin
+				if ast.literal_eval(self.receive(timeout, pending=ack).decode("UTF-8").strip()) is False:
+					return False
+				raise PyboardError("unexpected reply from device")
+			want = min(left, TRANSFER_CHUNK)
+			n = 0
+			while n < want:
+				got = f.readinto(mv[n:want])
+				if not got:
+					break
+				n += got
+			if n < want:
+				# The file shrank while uploading: the device still expects the announced size
+				mv[n:want] = bytes(want - n)
+				short = True
+			port.write(mv[:want])
+			self.sent += want
+			left -= want
+		reply = self.receive(timeout)
+		if short:
+			raise OSError("file changed while uploading")
+		try:
+			return ast.literal_eval(reply.decode("UTF-8").strip())
+		except (ValueError, SyntaxError):
+			raise PyboardError("unexpected reply from device: {!r}".format(reply[:80]))
+
+def benchmark_transport(port, baud, delay, rounds=20, size=4096):
+	""" Measures the link to a device without the helper: the median round trip of an empty command, and the
+	throughput of command upload and of output download. Returns (seconds, upload bytes/s, download bytes/s).
+	"""
+	with DeviceSession(port, baud, delay) as session:
+		latencies = sorted(session.round_trip() for i in range(rounds))
+		payload = "_=b'{}'".format("x" * size)
+		start = time.perf_counter()
+		for i in range(4):
+			session.exec(payload)
+		upload = 4 * size / (time.perf_counter() - start)
+		start = time.perf_counter()
+		received = 0
+		for i in range(4):
+			received += len(session.exec("import sys\nfor i in range({}):\n sys.stdout.write('x'*64)".format(size // 64)))
+		download = received / (time.perf_counter() - start)
+	return latencies[len(latencies) // 2], upload, download
+
+class PackStream(io.RawIOBase):
+	""" Local files and directories as one stream for the helper's unpack(): a "D 0 <path>\\n" or "F <size> <path>\\n"
+	header per entry, every file header followed by exactly <size> bytes of data. Files are only opened while they
+	are being read.
+	"""
+
+	def __init__(self, root, entries):
+		self.root = root
+		self.entries = entries		# [(relative path, size, or None for directories), ...], parents first
+		self.headers = [("{} {} {}\n".format("D" if size is None else "F", size or 0, rel)).encode("UTF-8")
+						for rel, size in entries]
+		self.size = sum(len(header) + (size or 0) for header, (rel, size) in zip(self.headers, entries))
+		self.index = -1
+		self.pending = b''		# rest of the current header
+		self.file = None
+		self.left = 0			# bytes of the current file still to read
+		self.changed = []		# files whose size changed after the stream was set up; they are padded or cut off
+
+	def readable(self):
+		return True
+
+	def readinto(self, b):
+		while True:
+			if self.pending:
+				n = min(len(b), len(self.pending))
+				b[:n] = self.pending[:n]
+				self.pending = self.pending[n:]
+				return n
+			if self.left:
+				want = min(len(b), self.left)
+				n = self.file.readinto(memoryview(b)[:want]) or 0
+				if not n:
+					self.changed.append(self.entries[self.index][0])
+					n = want
+					b[:n] = bytes(n)
+				self.left -= n
+				return n
+			if self.file is not None:
+				if self.file.read(1):
+					self.changed.append(self.entries[self.index][0])
+				self.file.close()
+				self.file = None
+			self.index += 1
+			if self.index >= len(self.entries):
+				return 0
+			rel, size = self.entries[self.index]
+			self.pending = self.headers[self.index]
+			if size:
+				self.file = open(os.path.join(self.root, rel), "rb")
+				self.left = size
+
+	def close(self):
+		if self.file is not None:
+			self.file.close()
+			self.file = None
+		super().close()
+
+class BlockStream(io.RawIOBase):
+	""" The TRANSFER_CHUNK blocks of a binary file object listed in ranges [[first block, count], ...], back to back,
+	for the helper's patch().
+	"""
+
+	def __init__(self, f, ranges, size):
+		self.f = f
+		self.spans = [(first * TRANSFER_CHUNK, min((first + count) * TRANSFER_CHUNK, size)) for first, count in ranges]
+		self.size = sum(end - start for start, end in self.spans)
+		self.index = 0
+		self.position = self.spans[0][0] if self.spans else 0
+
+	def readable(self):
+		return True
+
+	def readinto(self, b):
+		while self.index < len(self.spans):
+			end = self.spans[self.index][1]
+			if self.position < end:
+				self.f.seek(self.position)
+				n = self.f.readinto(memoryview(b)[:min(len(b), end - self.position)]) or 0
+				self.position += n
+				return n
+			self.index += 1
+			if self.index < len(self.spans):
+				self.position = self.spans[self.index][0]
+		return 0
+
+class RemoteManifest:
+	""" On-disk record of a device's filesystem (directory listings, sizes and known hashes), keyed by the device's
+	machine.unique_id(), so the remote view can be shown immediately on reconnect. `stamp` is the device helper's stamp()
+	at the time the listings were known to be consistent, or None if they may be outdated.
+	"""
+
+	def __init__(self, directory, device_id):
+		self.directory = directory
+		self.device_id = device_id
+		self.path = os.path.join(directory, "{}.json".format(device_id))
+		self.stamp = None
+		self.listings = {}		# remote directory -> [[name, type, size], ...]
+		self.hashes = {}		# remote file -> sha256
+		self.complete = False	# whether the listings cover the whole filesystem (after a full device walk)
+		try:
+			with open(self.path) as f:
+				data = json.load(f)
+			self.stamp = data["stamp"]
+			self.listings = data["listings"]
+			self.hashes = data["hashes"]
+			self.complete = data.get("complete", False)
+		except (OSError, ValueError, KeyError):
+			pass
+
+	@staticmethod
+	def key(path):
+		return "/" + path.strip("/")
+
+	def listing(self, path):
+		return self.listings.get(self.key(path))
+
+	def set_listing(self, path, entries):
+		self.listings[self.key(path)] = [list(entry) for entry in entries]
+
+	def forget(self, path):
+		""" Drops everything known about path and below, e.g. after it was deleted.
+		"""
+		path = self.key(path)
+		for table in (self.listings, self.hashes):
+			for key in [key for key in table if key == path or key.startswith(path + "/")]:
+				del table[key]
+
+	def clear(self):
+		self.stamp = None
+		self.listings = {}
+		self.hashes = {}
+		self.complete = False
+
+	def set_tree(self, stamp, found):
+		""" Replaces everything with the result of a full device walk, [(path, type, size), ...].
+		"""
+		self.clear()
+		self.stamp = stamp
+		self.listings["/"] = []
+		for path, ftype, size in found:
+			parent, name = path.rsplit("/", 1)
+			self.listings.setdefault(parent or "/", []).append([name, ftype, size])
+			if ftype == 'd':
+				self.listings.setdefault(path, [])
+		self.complete = True
+
+	def paths(self):
+		""" Yields (path, type, size) for every entry in the manifest.
+		"""
+		for directory, entries in self.listings.items():
+			prefix = directory.rstrip("/")
+			for name, ftype, size in entries:
+				yield prefix + "/" + name, ftype, size
+
+	def save(self):
+		os.makedirs(self.directory, exist_ok=True)
+		tmp_path = self.path + ".tmp"
+		with open(tmp_path, "w") as f:
+			json.dump({"stamp": self.stamp, "listings": self.listings, "hashes": self.hashes,
+					   "complete": self.complete}, f)
+		os.replace(tmp_path, self.path)
+
+	@staticmethod
+	def last_device(directory, port):
+		""" Returns the ID of the device last seen on port, if any.
+		"""
+		try:
+			with open(os.path.join(directory, "ports.json")) as f:
+				return json.load(f).get(port)
+		except (OSError, ValueError):
+			return None
+
+	@staticmethod
+	def remember_device(directory, port, device_id):
+		os.makedirs(directory, exist_ok=True)
+		ports_file = os.path.join(directory, "ports.json")
+		try:
+			with open(ports_file) as f:
+				ports = json.load(f)
+		except (OSError, ValueError):
+			ports = {}
+		if ports.get(port) != device_id:
+			ports[port] = device_id
+			with open(ports_file, "w") as f:
+				json.dump(ports, f)
+
+def bench_functions(source):
+	""" Names of the top-level bench_* functions of a benchmark file, in file order.
+	"""
+	return [node.name for node in ast.parse(source).body
+			if isinstance(node, ast.FunctionDef) and node.name.startswith("bench_")]
+
+def bench_stats(times):
+	""" min, median and 95th percentile of the microseconds of a benchmark's runs.
+	"""
+	times = sorted(times)
+	middle = len(times) // 2
+	median = times[middle] if len(times) % 2 else (times[middle - 1] + times[middle]) / 2
+	return {"min": times[0], "median": median, "p95": times[max(0, -(-len(times) * 95 // 100) - 1)], "runs": times}
+
+def bench_reply(out):
+	""" Splits the output of a _bench() call (see BENCH_HARNESS) into what the benchmarked function printed and the
+	microseconds of its runs.
+	"""
+	start = out.rfind(b'\x1e')
+	end = out.find(b'\x1f', start)
+	try:
+		if start < 0 or end < 0:
+			raise ValueError
+		return out[:start] + out[end + 1:], ast.literal_eval(out[start + 1:end].decode("UTF-8"))
+	except (ValueError, SyntaxError):
+		raise PyboardError("unexpected reply from device: {!r}".format(out[-80:]))
+
+def source_commit(path):
+	""" Short git commit of the repository a local file is in, with '+dirty' if it has uncommitted changes, or None.
+	"""
+	directory = os.path.dirname(os.path.abspath(path))
+	try:
+		head = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=directory, capture_output=True)
+		if head.returncode != 0:
+			return None
+		dirty = subprocess.run(["git", "diff", "--quiet", "HEAD"], cwd=directory, capture_output=True).returncode != 0
+	except OSError:
+		return None
+	return head.stdout.decode("ascii").strip() + ("+dirty" if dirty else "")
+
+def local_size(path):
+	""" Size of a local file, or the total size of the files below a directory.
+	"""
+	if not os.path.isdir(path):
+		return os.path.getsize(path)
+	return sum(os.path.getsize(os.path.join(root, name)) for root, dirs, files in os.walk(path) for name in files)
+
+def ignored(name):
+	""" Whether a local file is left out of listings: ignore_files, and downloads that did not finish.
+	"""
+	return name in ignore_files or name.endswith(PART_SUFFIX)
+
+def hash_local_file(path):
+	""" Returns the hex sha256 of a local file, or None if it can't be read.
+	"""
+	h = hashlib.sha256()
+	try:
+		with open(path, "rb") as f:
+			for block in iter(lambda: f.read(1 << 16), b""):
+				h.update(block)
+	except OSError:
+		return None
+	return h.hexdigest()
+
+class LocalIndex:
+	""" Persistent index of a local directory tree: relative path -> [size, mtime_ns, sha256]. Only files whose size or
+	mtime changed since the last scan are hashed again, and large batches are hashed in a thread pool (hashlib releases
+	the GIL while it hashes).
+	"""
+
+	POOL_THRESHOLD = 64		# number of files to hash before a thread pool pays off
+	RACY_NS = 2000000000	# files modified this recently may change again within the same mtime, don't trust them
+
+	def __init__(self, root, cache_dir):
+		self.root = root
+		self.cache_dir = cache_dir
+		self.path = os.path.join(cache_dir, hashlib.sha1(root.encode("UTF-8")).hexdigest() + ".json")
+		self.entries = {}
+		try:
+			with open(self.path) as f:
+				data = json.load(f)
+			if data["root"] == root:
+				self.entries = data["entries"]
+		except (OSError, ValueError, KeyError):
+			pass
+
+	def walk(self, start="", dirs=False):
+		""" Yields (relative path, stat) of every file below root, or below its subdirectory start, skipping
+		ignore_files like the local file browser. Directories are included when dirs is set.
+		"""
+		stack = [start]
+		while stack:
+			rel_dir = stack.pop()
+			try:
+				with os.scandir(os.path.join(self.root, rel_dir)) as it:
+					for entry in it:
+						if ignored(entry.name):
+							continue
+						rel = rel_dir + "/" + entry.name if rel_dir else entry.name
+						try:
+							if entry.is_dir(follow_symlinks=False):
+								stack.append(rel)
+								if dirs:
+									yield rel, entry.stat()
+							elif entry.is_file():
+								yield rel, entry.stat()
+						except OSError:
+							continue
+			except OSError:
+				continue
+
+	def scan(self):
+		""" Brings the whole index up to date, saves it if anything changed, and returns the entries.
+		"""
+		scan_start = time.time_ns()
+		entries = {}
+		stale = []
+		for rel, st in self.walk():
+			known = self.entries.get(rel)
+			if known is not None and known[0] == st.st_size and known[1] == st.st_mtime_ns:
+				entries[rel] = known
+			else:
+				entries[rel] = [st.st_size, st.st_mtime_ns, None]
+				stale.append(rel)
+
+		if stale:
+			paths = [os.path.join(self.root, rel) for rel in stale]
+			if len(stale) >= self.POOL_THRESHOLD:
+				with ThreadPoolExecutor() as pool:
+					hashes = list(pool.map(hash_local_file, paths))
+			else:
+				hashes = [hash_local_file(path) for path in paths]
+			for rel, digest in zip(stale, hashes):
+				if digest is None:
+					del entries[rel]
+					continue
+				entries[rel][2] = digest
+				if entries[rel][1] > scan_start - self.RACY_NS:
+					entries[rel][1] = -1
+
+		changed = bool(stale) or entries.keys() != self.entries.keys()
+		self.entries = entries
+		if changed:
+			self.save()
+		return self.entries
+
+	def lookup(self, rel):
+		""" Returns the up to date sha256 of a single file (None if it doesn't exist), without scanning the whole tree.
+		Call save() afterwards to keep the result.
+		"""
+		try:
+			st = os.stat(os.path.join(self.root, rel))
+		except OSError:
+			self.entries.pop(rel, None)
+			return None
+		known = self.entries.get(rel)
+		if known is not None and known[0] == st.st_size and known[1] == st.st_mtime_ns:
+			return known[2]
+		digest = hash_local_file(os.path.join(self.root, rel))
+		mtime = st.st_mtime_ns if st.st_mtime_ns <= time.time_ns() - self.RACY_NS else -1
+		self.entries[rel] = [st.st_size, mtime, digest]
+		return digest
+
+	def save(self):
+		os.makedirs(self.cache_dir, exist_ok=True)
+		tmp_path = self.path + ".tmp"
+		with open(tmp_path, "w") as f:
+			json.dump({"root": self.root, "entries": self.entries}, f)
+		os.replace(tmp_path, self.path)
+
+class BackupWriter:
+	""" Writes a tar archive of device files as they are streamed in: each member header is written up front from the
+	size reported by the device, so file contents go from the port to disk without being held in memory. The archive
+	is written to a temporary file and only takes its final name once close() added the manifest.
+	"""
+
+	def __init__(self, path, device_id):
+		self.path = path
+		self.f = open(path + ".part", "wb")
+		self.manifest = {"device_id": device_id, "created": int(time.time()), "dirs": [], "files": {}}
+		self.sha = None
+		self.written = 0
+
+	def add_dir(self, name):
+		info = tarfile.TarInfo(name)
+		info.type = tarfile.DIRTYPE
+		info.mode = 0o755
+		info.mtime = self.manifest["created"]
+		self.f.write(info.tobuf())
+		self.manifest["dirs"].append(name)
+
+	def add_file(self, name, size, fill):
+		""" Adds a member of size bytes, whose data fill() passes to write(). Returns its sha256.
+		"""
+		info = tarfile.TarInfo(name)
+		info.size = size
+		info.mode = 0o644
+		info.mtime = self.manifest["created"]
+		self.f.write(info.tobuf())
+		self.sha = hashlib.sha256()
+		self.written = 0
+		fill()
+		if self.written != size:
+			raise OSError("'{}' changed size while backing up".format(name))
+		self.f.write(bytes(-size % tarfile.BLOCKSIZE))
+		digest = self.sha.hexdigest()
+		self.manifest["files"][name] = [size, digest]
+		return digest
+
+	def write(self, data):
+		self.sha.update(data)
+		self.written += len(data)
+		self.f.write(data)
+
+	def close(self):
+		data = json.dumps(self.manifest, indent=1).encode("UTF-8")
+		info = tarfile.TarInfo(BACKUP_MANIFEST)
+		info.size = len(data)
+		info.mtime = self.manifest["created"]
+		self.f.write(info.tobuf())
+		self.f.write(data + bytes(-len(data) % tarfile.BLOCKSIZE))
+		self.f.write(bytes(2 * tarfile.BLOCKSIZE))
+		self.f.close()
+		os.replace(self.path + ".part", self.path)
+
+	def abort(self):
+		self.f.close()
+		os.remove(self.path + ".part")
+
+def match_remote_paths(index, pattern, limit=500):
+	""" Filters a remote search index, [(lowercase path, path, type), ...], with a case-insensitive substring. A pattern
+	with wildcards is matched as a glob against the file name, or against the full path if it contains a '/'.
+	"""
+	pattern = pattern.lower()
+	if any(c in pattern for c in "*?["):
+		if "/" in pattern:
+			test = lambda lower: fnmatch.fnmatchcase(lower, pattern)
+		else:
+			test = lambda lower: fnmatch.fnmatchcase(lower.rsplit("/", 1)[-1], pattern)
+	else:
+		test = lambda lower: pattern in lower
+	hits = []
+	for lower, path, ftype in index:
+		if test(lower):
+			hits.append((path, ftype))
+			if len(hits) >= limit:
+				break
+	return hits
+
+class ListingCache:
+	""" Bounded LRU of remote directory listings (path -> entries), filled by prefetch_listings(). Thread safe.
+	"""
+
+	def __init__(self, size=64):
+		self.size = size
+		self.listings = OrderedDict()
+		self.lock = Lock()
+
+	def __contains__(self, path):
+		return RemoteManifest.key(path) in self.listings
+
+	def get(self, path):
+		path = RemoteManifest.key(path)
+		with self.lock:
+			entries = self.listings.get(path)
+			if entries is not None:
+				self.listings.move_to_end(path)
+			return entries
+
+	def put(self, path, entries):
+		path = RemoteManifest.key(path)
+		with self.lock:
+			self.listings[path] = entries
+			self.listings.move_to_end(path)
+			while len(self.listings) > self.size:
+				self.listings.popitem(last=False)
+
+	def forget(self, path):
+		path = RemoteManifest.key(path)
+		with self.lock:
+			for key in [key for key in self.listings if key == path or key.startswith(path + "/")]:
+				del self.listings[key]
+
+	def clear(self):
+		with self.lock:
+			self.listings.clear()
+
+class DeviceLock:
+	""" The lock of the device port, held by whoever talks to the device. Long running work checks contended() between
+	steps, so it can give the port up as soon as a user operation waits.
+	While nobody holds it, the port belongs to console (a ReplConsole), which is paused for every holder and lends it
+	the port it keeps open.
+	"""
+
+	def __init__(self):
+		self.lock = RLock()
+		self.counter = Lock()
+		self.waiting = 0
+		self.depth = 0			# recursion depth of the holder
+		self.console = None
+
+	def acquire(self):
+		with self.counter:
+			self.waiting += 1
+		try:
+			self.take()
+		finally:
+			with self.counter:
+				self.waiting -= 1
+
+	def take(self, timeout=-1):
+		""" Acquires the lock without counting as waiting, see contended(). Returns False if it was not free within
+		timeout seconds.
+		"""
+		if not self.lock.acquire(timeout=timeout):
+			return False
+		self.depth += 1
+		if self.depth == 1 and self.console is not None:
+			try:
+				self.console.pause()
+			except BaseException:
+				self.depth -= 1
+				self.lock.release()
+				raise
+		return True
+
+	def release(self):
+		self.depth -= 1
+		try:
+			if self.depth == 0 and self.console is not None:
+				self.console.resume()
+		finally:
+			self.lock.release()
+
+	def __enter__(self):
+		self.acquire()
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.release()
+
+	def contended(self):
+		return self.waiting > 0
+
+class ReplScreen:
+	""" Turns the output of the device REPL into text: the completed lines, and the line being edited, to which the
+	cursor moves and erases of MicroPython's readline (backspace, ESC[nD, ESC[nC, ESC[K) are applied.
+	"""
+
+	def __init__(self):
+		self.line = []			# characters of the current line
+		self.col = 0			# cursor position in it
+		self.escape = None		# escape sequence being read
+		self.decoder = codecs.getincrementaldecoder("UTF-8")("replace")
+
+	def feed(self, data):
+		""" Returns the lines completed by data, the current line is in text().
+		"""
+		done = []
+		for ch in self.decoder.decode(data):
+			if self.escape is not None:
+				self.escape += ch
+				if self.escape != "[" and not (self.escape.startswith("[") and (ch.isdigit() or ch == ";")):
+					self.apply_escape(self.escape)
+					self.escape = None
+			elif ch == "\x1b":
+				self.escape = ""
+			elif ch == "\n":
+				done.append(self.text())
+				self.line = []
+				self.col = 0
+			elif ch == "\r":
+				self.col = 0
+			elif ch == "\x08":
+				self.col = max(0, self.col - 1)
+			elif ch >= " " or ch == "\t":
+				if self.col < len(self.line):
+					self.line[self.col] = ch
+				else:
+					self.line.append(ch)
+				self.col += 1
+		return done
+
+	def apply_escape(self, sequence):
+		# Only CSI sequences are known, anything else is dropped
+		if not sequence.startswith("["):
+			return
+		try:
+			n = int(sequence[1:-1] or 1)
+		except ValueError:
+			return
+		if sequence[-1] == "D":
+			self.col = max(0, self.col - n)
+		elif sequence[-1] == "C":
+			self.col += n
+			self.line += [" "] * (self.col - len(self.line))
+		elif sequence[-1] == "K":
+			del self.line[self.col:]
+
+	def text(self):
+		return "".join(self.line)
+
+class ReplConsole:
+	""" The interactive REPL of the device, also used to capture its output. While it runs, a reader thread reads the
+	port and hands the output to on_output(bytes), batched to at most one call per FRAME seconds. Set as the console of a
+	DeviceLock, it stops reading for every device operation, which borrows the port it keeps open (see lend()).
+	"""
+
+	FRAME = 0.03
+
+	def __init__(self, port, baud, on_output, on_closed):
+		self.port = port
+		self.baud = int(baud)
+		self.on_output = on_output
+		self.on_closed = on_closed		# called with an error message when the port could not be opened again
+		self.serial = None
+		self.reading = False
+		self.thread = None
+		self.stop = Event()
+		self.write_lock = Lock()
+
+	def resume(self):
+		""" Starts the reader, on the port kept open while paused, or on a new one if there is none.
+		"""
+		if self.reading:
+			return
+		port = self.serial
+		if port is None:
+			try:
+				port = transport_for(self.port).open(self.port, self.baud)
+			except (serial.SerialException, OSError) as ex:
+				self.on_closed(device_error_text(ex))
+				return
+		port.timeout = self.FRAME
+		self.stop.clear()
+		with self.write_lock:
+			self.serial = port
+			self.reading = True
+		self.thread = Thread(target=self.read_loop, args=(port,), name="REPL reader", daemon=True)
+		self.thread.start()
+
+	def pause(self):
+		""" Stops the reader after it passed on everything received so far. The port stays open: opening it again
+		would toggle DTR/RTS, which resets many boards, and lose what the device prints in between.
+		"""
+		if not self.reading:
+			return
+		self.stop.set()
+		self.thread.join()
+		with self.write_lock:
+			self.reading = False
+
+	def close(self):
+		""" Stops the reader and closes the port.
+		"""
+		self.pause()
+		with self.write_lock:
+			if self.serial is not None:
+				self.serial.close()
+				self.serial = None
+
+	def lend(self, port, baud):
+		""" The open port of the paused console for a device operation on port at baud, or None if it has none.
+		"""
+		if self.reading or self.port != port or self.baud != int(baud):
+			return None
+		return self.serial
+
+	def running(self):
+		return self.reading and self.thread.is_alive()
+
+	def write(self, data):
+		""" Sends keystrokes to the device, they are dropped while the console is paused.
+		"""
+		with self.write_lock:
+			if self.reading and self.serial is not None:
+				try:
+					self.serial.write(data)
+				except (serial.SerialException, OSError):
+					pass
+
+	def read_loop(self, port):
+		frame = bytearray()
+		flushed = time.monotonic()
+		while True:
+			try:
+				if self.stop.is_set():
+					# Whatever already arrived belongs to the capture, not to the operation that paused it
+					frame += port.read(port.in_waiting)
+					break
+				data = port.read(port.in_waiting or 1)
+			except (serial.SerialException, OSError) as ex:
+				with self.write_lock:
+					port.close()
+					self.serial = None
+				self.on_closed(device_error_text(ex))
+				break
+			frame += data
+			# Sent when the device goes quiet, or once per frame while it keeps talking
+			if frame and (not data or time.monotonic() - flushed >= self.FRAME):
+				self.on_output(bytes(frame))
+				frame = bytearray()
+				flushed = time.monotonic()
+		if frame:
+			self.on_output(bytes(frame))
+
+class ProfileStream:
+	""" Splits the output of a profiled run (see PROFILE_RUN) into the script's own output, passed to on_text(str) a
+	line at a time, the samples and the mem_info() text.
+	"""
+
+	def __init__(self, on_text):
+		self.on_text = on_text
+		self.samples = []		# (milliseconds since start, free bytes, allocated bytes)
+		self.mem_info = None	# lines of micropython.mem_info(), if the port has it
+		self.mem_text = None	# mem_info() output while it is being read
+		self.pending = ""		# text after the last complete record
+		self.line = ""			# script output after the last newline
+		self.decoder = codecs.getincrementaldecoder("UTF-8")("replace")
+
+	def feed(self, data):
+		text = self.pending + self.decoder.decode(data).replace("\r", "")
+		while True:
+			start = text.find("\x1e")
+			if start < 0:
+				break
+			end = text.find("\x1f", start)
+			if end < 0:
+				break
+			self.emit(text[:start])
+			self.record(text[start + 1:end])
+			text = text[end + 1:]
+		# A record may be cut off at the end
+		start = text.find("\x1e")
+		self.pending = text[start:] if start >= 0 else ""
+		self.emit(text[:start] if start >= 0 else text)
+
+	def record(self, record):
+		if record == "M":
+			self.mem_text = ""
+		elif record == "/M":
+			self.mem_info = [line for line in self.mem_text.split("\n") if line]
+			self.mem_text = None
+		else:
+			t, free, alloc = (int(value) for value in record.split(","))
+			self.samples.append((t / 1000, free, alloc))
+
+	def emit(self, text):
+		if self.mem_text is not None:
+			self.mem_text += text
+			return
+		self.line += text
+		end = self.line.rfind("\n")
+		if end >= 0:
+			self.on_text(self.line[:end + 1])
+			self.line = self.line[end + 1:]
+
+	def close(self):
+		if self.line:
+			self.on_text(self.line + "\n")
+			self.line = ""
+
+	def summary(self):
+		""" Lines describing the heap over the run.
+		"""
+		if not self.samples:
+			return ["No memory samples"]
+		peak = max(self.samples, key=lambda sample: sample[2])
+		lowest = min(sample[1] for sample in self.samples)
+		lines = ["{:.3f}s, {} sample(s)".format(self.samples[-1][0] / 1000, len(self.samples)),
+				 "Heap allocated: {} B at start, peak {} B at {:.3f}s, {} B at the end; lowest free {} B".format(
+					 self.samples[0][2], peak[2], peak[0] / 1000, self.samples[-1][2], lowest)]
+		if len(self.samples) > 2:
+			# Peak allocation in 40 equal slices of the run, as bars
+			bars = "\u2581\u2582\u2583\u2584\u2585\u2586\u2587\u2588"
+			end = self.samples[-1][0] or 1
+			slices = [0] * 40
+			for t, free, alloc in self.samples:
+				index = min(39, int(t / end * 40))
+				slices[index] = max(slices[index], alloc)
+			top = max(slices) or 1
+			lines.append("Allocated over time: " + "".join(bars[min(7, alloc * 8 // top)] if alloc else " " for alloc in slices))
+		return lines + (self.mem_info or [])
+
+	def write_csv(self, path):
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		with open(path, "w") as f:
+			f.write("time_ms,mem_free,mem_alloc\n")
+			for t, free, alloc in self.samples:
+				f.write("{:.3f},{},{}\n".format(t, free, alloc))
+
+class CaptureLog:
+	""" Writes device output as timestamped lines to size-rotated log files: path, then path.1 (the previous one) up to
+	path.<keep>. Lines get the arrival time of the batch they came in with. Only a partial line is held in memory.
+	"""
+
+	MAX_LINE = 4096		# longer lines are cut, so a device that never sends a newline can't grow the buffer
+
+	def __init__(self, path, max_bytes=1 << 20, keep=5):
+		self.path = path
+		self.max_bytes = max_bytes
+		self.keep = keep
+		self.lock = Lock()
+		self.partial = bytearray()
+		self.lines = 0			# lines written so far
+		self.tail = ""			# the last one
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		self.file = open(path, "ab")
+
+	def write(self, data):
+		with self.lock:
+			if self.file is None:
+				return
+			stamp = datetime.datetime.now().isoformat(sep=" ", timespec="milliseconds").encode("ascii")
+			pieces = data.replace(b'\r', b'').replace(b'\x04', b'').split(b'\n')
+			rest = pieces.pop()
+			if pieces:
+				pieces[0] = bytes(self.partial) + pieces[0]
+				self.partial = bytearray()
+			self.partial += rest
+			if len(self.partial) > self.MAX_LINE:
+				pieces.append(bytes(self.partial))
+				self.partial = bytearray()
+			for line in pieces:
+				self.file.write(stamp + b' ' + line + b'\n')
+				self.tail = line.decode("UTF-8", "replace")
+				self.lines += 1
+			if pieces and self.file.tell() >= self.max_bytes:
+				self.rotate()
+
+	def rotate(self):
+		self.file.close()
+		for i in range(self.keep - 1, 0, -1):
+			if os.path.exists("{}.{}".format(self.path, i)):
+				os.replace("{}.{}".format(self.path, i), "{}.{}".format(self.path, i + 1))
+		os.replace(self.path, self.path + ".1")
+		self.file = open(self.path, "ab")
+
+	def close(self):
+		with self.lock:
+			if self.file is not None:
+				if self.partial:
+					self.file.write(bytes(self.partial) + b'\n')
+				self.file.close()
+				self.file = None
+
+class RemoteIndex:
+	""" The entries of the remote directory on display: name -> (type, size), plus the names in display order
+	(directories first, then files, both alphabetically), so single entries can be added or removed without
+	re-sorting or rebuilding anything.
+	"""
+
+	def __init__(self, entries=()):
+		self.replace(entries)
+
+	@staticmethod
+	def sort_key(name, ftype):
+		return (0 if ftype == 'd' else 1, name.upper(), name)
+
+	def replace(self, entries):
+		self.entries = {name: (ftype, size) for name, ftype, size in entries}
+		self.order = sorted(self.sort_key(name, entry[0]) for name, entry in self.entries.items())
+
+	def __contains__(self, name):
+		return name in self.entries
+
+	def __len__(self):
+		return len(self.entries)
+
+	def __iter__(self):
+		""" Yields (name, type, size) in display order.
+		"""
+		for key in self.order:
+			yield (key[2],) + self.entries[key[2]]
+
+	def get(self, name):
+		return self.entries.get(name)
+
+	def position(self, name):
+		return bisect.bisect_left(self.order, self.sort_key(name, self.entries[name][0]))
+
+	def add(self, name, ftype, size=0):
+		""" Adds or updates an entry. Returns its new position, or None if only its metadata changed.
+		"""
+		existing = self.entries.get(name)
+		if existing is not None and existing[0] == ftype:
+			self.entries[name] = (ftype, size)
+			return None
+		if existing is not None:
+			self.remove(name)
+		self.entries[name] = (ftype, size)
+		key = self.sort_key(name, ftype)
+		position = bisect.bisect_left(self.order, key)
+		self.order.insert(position, key)
+		return position
+
+	def remove(self, name):
+		""" Removes an entry and returns the position it had.
+		"""
+		position = self.position(name)
+		del self.order[position]
+		del self.entries[name]
+		return position
+
 class AppWindow(Gtk.ApplicationWindow):
 	debug = False
 
@@ -30,14 +1768,18 @@ class AppWindow(Gtk.ApplicationWindow):
 	timeout_delay = 120  	# After how many seconds the connection should be checked again
 
 	connected = False
+	check_interval = 2		# seconds a successful device check is reused, and the throttle interval of UI-triggered checks
+	last_check = 0			# time.monotonic() of the last successful device check
+	pending_check = None	# GLib source of a scheduled device check
 
 	local_treeview = None
 	remote_treeview = None
 
-	remote_dirs = []
-	remote_files = []
+	remote_index = None
 
 	run_local_button = None
+	watch_button = None
+	bench_button = None
 
 	remote_refresh_button = None
 	
@@ -50,6 +1792,14 @@ class AppWindow(Gtk.ApplicationWindow):
 
 	terminal_buffer = None
 
+	terminal_notebook = None
+	repl_view = None
+	repl_console = None		# ReplConsole while the REPL tab is open or output is captured, on a connected device
+	repl_visible = False
+	capture = None			# CaptureLog while the device output is captured
+	capture_check = None
+	profile_check = None
+
 	def __init__(self, debug=False, use_timeout=True, timeout_delay=120, *args, **kwargs):
 		super().__init__(*args, **kwargs)
 
@@ -64,6 +1814,7 @@ class AppWindow(Gtk.ApplicationWindow):
 		self.ICON = 0
 		self.FILENAME = 1
 		self.TYPE = 2
+		self.PATH = 3	# remote treeview only: path relative to current_remote_path, '' for the placeholder row of an unloaded directory
 
 		
 		self.current_local_path = os.getcwd()
@@ -71,6 +1822,11 @@ class AppWindow(Gtk.ApplicationWindow):
 		self.progpath = os.path.join(os.getcwd(), os.path.dirname(__file__))
 	
 		self.current_remote_path = ''
+		self.remote_index = RemoteIndex()	# entries of the remote directory shown in the remote treeview
+		self.remote_search_active = False	# whether the remote treeview shows search results
+		self.remote_search_cache = None		# [(lowercase path, path, type), ...] of the whole device while searching
+		self.pixbufs = {}
+		self.local_indexes = {}		# local root -> LocalIndex
 
 		css = b"""
 			textview text {
@@ -104,11 +1860,33 @@ class AppWindow(Gtk.ApplicationWindow):
 		# Load settings from a configuration file
 		config = configparser.ConfigParser()
 		config.read(os.path.join(self.progpath, 'config.ini'))
+		self.config = config
 		try:
 			self.ampy_args = [config['DEFAULT']['port'], config['DEFAULT']['baud'], config['DEFAULT']['delay']]
 		except KeyError:
 			print("Could not load configurations, falling back to defaults.")
 			self.ampy_args = ['/dev/ttyUSB0', '115200', '0']
+		self.use_helper = config['DEFAULT'].getboolean('helper', True)	# use the resident device helper (util/ampygui_helper.py)
+		self.helper_state = None	# None: not checked yet on this connection, True: installed and current, False: unavailable
+		self.device_id = None		# machine.unique_id() of the connected device, as reported by the helper
+		self.link_baud_failed = False
+		self.manifest = None		# RemoteManifest of the connected device
+		self.manifest_fresh = False	# whether the manifest listings are known to match the device
+		self.device_lock = DeviceLock()	# held by whoever talks to the device, see run_ampy() and open_session()
+		self.listing_cache = ListingCache()	# prefetched listings of sub-directories, see prefetch_listings()
+		self.prefetch_generation = 0		# bumped on every listing, so outdated prefetch runs stop
+		self.deadline = config['DEFAULT'].getfloat('deadline', 10)	# seconds a device operation may take, plus its payload at min_rate
+		self.min_rate = config['DEFAULT'].getfloat('min_rate', 1000)
+		self.timeout_stats = TimeoutStats()
+		# Watch mode, see watch_tick(): uploads changed local files, resets the device and runs watch_entry
+		self.watch_entry = config['DEFAULT'].get('watch_entry', 'main.py')	# default entry script, relative to the watched directory
+		self.watch_reset = config['DEFAULT'].get('watch_reset', 'soft')		# soft, reimport or none
+		self.watch_timeout = config['DEFAULT'].getfloat('watch_timeout', 0)	# seconds the entry script may run, 0: until the next change
+		self.watch_state = None		# (local root, remote root, entry) while watching
+		self.watch_seen = {}		# last polled snapshot, relative path -> (size, mtime_ns)
+		self.watch_deployed = {}	# sha256 of what is on the device, by relative path
+		self.watch_changed_at = 0
+		self.watch_generation = 0	# bumped on every deploy, so a running entry script is stopped
 		self.update_ampy_command()
 		
 		self.baud_rates=["300", "600", "1200", "2400", "4800", "9600", "14400", "19200", "28800", "38400", "57600","115200",
@@ -148,6 +1926,9 @@ class AppWindow(Gtk.ApplicationWindow):
 
 		select_port_button = Gtk.Button.new_with_label("Select Port")
 		connect_button = Gtk.Button.new_with_label("Connect")
+		self.probe_button = Gtk.Button.new_with_label("Probe link")
+		self.probe_button.set_sensitive(False)
+		self.probe_button.set_tooltip_text("Find the fastest baud rate that works reliably with the connected device.")
 
 		port_box.pack_start(port_label,False,False,0)
 		port_box.pack_start(port_entry,False,False,0)
@@ -163,6 +1944,7 @@ class AppWindow(Gtk.ApplicationWindow):
 		settingsbox.pack_start(baud_box,True,True,0)
 		settingsbox.pack_start(delay_box,True,True,0)
 		settingsbox.pack_start(connect_button,True,True,0)
+		settingsbox.pack_start(self.probe_button,True,True,0)
 
 		settings_frame = Gtk.Frame()
 		settings_frame.add(settingsbox)
@@ -191,6 +1973,7 @@ class AppWindow(Gtk.ApplicationWindow):
 		self.setup_remote_tree_view(self.remote_treeview)
 		self.setup_remote_tree_model(self.remote_treeview)
 		self.remote_treeview.connect("row-activated", self.on_remote_row_activated)
+		self.remote_treeview.connect("test-expand-row", self.on_remote_row_expand)
 		self.remote_treeview.get_selection().connect("changed", self.on_remote_row_selected)
 
 		#CREATE SCROLLED WINDOWS
@@ -229,6 +2012,12 @@ class AppWindow(Gtk.ApplicationWindow):
 		remote_scrolled_win.add(self.remote_treeview)
 
 		remote_box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=6,halign="fill")
+		self.remote_search_entry = Gtk.SearchEntry()
+		self.remote_search_entry.set_sensitive(False)
+		self.remote_search_entry.set_placeholder_text("Search device")
+		self.remote_search_entry.set_tooltip_text("Find files anywhere on the remote device, by name or glob (e.g. *.mpy).")
+		self.remote_search_entry.connect("search-changed", self.on_remote_search_changed)
+		remote_box.pack_start(self.remote_search_entry,False,False,0)
 		remote_box.pack_start(remote_scrolled_win,True,True,0)
 		self.remote_refresh_button = Gtk.Button.new_with_label("Refresh")
 		self.remote_refresh_button.set_sensitive(False)
@@ -244,7 +2033,19 @@ class AppWindow(Gtk.ApplicationWindow):
 		self.run_local_button.set_sensitive(False)
 		self.run_local_button.set_tooltip_text("Run the selected local file on the remote device.")
 
+		self.watch_button = Gtk.ToggleButton.new_with_label("WATCH")
+		self.watch_button.set_sensitive(False)
+		self.watch_button.set_tooltip_text("Upload files of this directory to the current remote directory as they change, "
+										   "reset the device and run the selected file (or main.py).")
+
+		self.bench_button = Gtk.Button.new_with_label("BENCH")
+		self.bench_button.set_sensitive(False)
+		self.bench_button.set_tooltip_text("Time the bench_* functions of the selected local file on the remote device, and compare "
+										   "them with the previous results.")
+
 		local_buttons_box.pack_start(self.run_local_button, False, False, 0)
+		local_buttons_box.pack_start(self.watch_button, False, False, 0)
+		local_buttons_box.pack_start(self.bench_button, False, False, 0)
 
 		# PACK IT UP
 		# Create Frame for Remote Services
@@ -261,8 +2062,12 @@ class AppWindow(Gtk.ApplicationWindow):
 		self.get_button.set_tooltip_text("Download the selected remote file to the local device.")
 		self.put_button.set_tooltip_text("Upload the selected local file to the remote device.")
 
+		self.pack_check = Gtk.CheckButton.new_with_label("Pack")
+		self.pack_check.set_tooltip_text("Upload everything in one packed stream that is unpacked on the device. Much faster for many small files.")
+
 		putget_box.pack_start(self.get_button,False,False,0)
 		putget_box.pack_start(self.put_button,False,False,0)
+		putget_box.pack_start(self.pack_check,False,False,0)
 
 		#DEFINE REMOTE FUNCTION BOXES
 		remote_buttons_box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=6,valign="center")
@@ -272,21 +2077,29 @@ class AppWindow(Gtk.ApplicationWindow):
 		self.run_remote_button = Gtk.Button.new_with_label("RUN")
 		self.reset_button = Gtk.Button.new_with_label("RESET")
 		self.delete_button = Gtk.Button.new_with_label("DELETE")
+		self.backup_button = Gtk.Button.new_with_label("BACKUP")
+		self.restore_button = Gtk.Button.new_with_label("RESTORE")
 
 		self.mkdir_button.set_sensitive(False)
 		self.run_remote_button.set_sensitive(False)
 		self.reset_button.set_sensitive(False)
 		self.delete_button.set_sensitive(False)
+		self.backup_button.set_sensitive(False)
+		self.restore_button.set_sensitive(False)
 
 		self.mkdir_button.set_tooltip_text("Create a new directory on the remote device.")
 		self.run_remote_button.set_tooltip_text("Run the selected remote file on the remote device.")
 		self.reset_button.set_tooltip_text("Perform a soft reset/reboot of the remote device.")
 		self.delete_button.set_tooltip_text("Delete the selected files/directories from the remote device.")
+		self.backup_button.set_tooltip_text("Save all files of the remote device into one local archive.")
+		self.restore_button.set_tooltip_text("Write a backup archive back to the remote device, skipping files that match.")
 
 		remote_buttons_box.pack_start(self.mkdir_button,False,False,0)
 		remote_buttons_box.pack_start(self.delete_button,False,False,0)
 		remote_buttons_box.pack_start(self.reset_button,False,False,0)
 		remote_buttons_box.pack_start(self.run_remote_button,False,False,0)
+		remote_buttons_box.pack_start(self.backup_button,False,False,0)
+		remote_buttons_box.pack_start(self.restore_button,False,False,0)
 
 		#PACK IT UP
 		#Create Frame for Remote Services
@@ -317,18 +2130,39 @@ class AppWindow(Gtk.ApplicationWindow):
 
 		terminal_scroll = Gtk.ScrolledWindow()
 		terminal_scroll.add(self.terminal_view)
-		terminal_window.pack_start(terminal_scroll,True,True,6)
+
+		# The REPL tab talks to the device directly, see start_console()
+		self.repl_view = Gtk.TextView()
+		self.repl_view.set_property('editable',False)
+		self.repl_view.set_monospace(True)
+		self.repl_view.connect("key-press-event", self.on_repl_key_press)
+		self.repl_buffer = self.repl_view.get_buffer()
+		self.repl_line = self.repl_buffer.create_mark(None, self.repl_buffer.get_end_iter(), True)	# start of the line being edited
+		self.repl_screen = ReplScreen()
+		repl_scroll = Gtk.ScrolledWindow()
+		repl_scroll.add(self.repl_view)
+
+		self.terminal_notebook = Gtk.Notebook()
+		self.terminal_notebook.append_page(terminal_scroll, Gtk.Label.new("Output"))
+		self.terminal_notebook.append_page(repl_scroll, Gtk.Label.new("REPL"))
+		self.terminal_notebook.connect("switch-page", self.on_terminal_page_switched)
+		terminal_window.pack_start(self.terminal_notebook,True,True,6)
 
 		# TIE ACTIONS TO BUTTONS
 		select_port_button.connect("clicked", self.select_port_popup, port_entry)
 		connect_button.connect("clicked", self.connect_device, self.remote_treeview, self.terminal_view, self.terminal_buffer)
+		self.probe_button.connect("clicked", self.probe_link_button_clicked, self.terminal_buffer)
 		self.put_button.connect("clicked", self.put_button_clicked, self.local_treeview, self.remote_treeview, self.terminal_buffer)
 		self.get_button.connect("clicked", self.get_button_clicked, self.local_treeview, self.remote_treeview, self.terminal_buffer)
 		self.run_local_button.connect("clicked", self.run_local_button_clicked, self.local_treeview, self.terminal_buffer)
+		self.watch_button.connect("toggled", self.watch_button_toggled, self.local_treeview, self.terminal_buffer)
+		self.bench_button.connect("clicked", self.bench_button_clicked, self.local_treeview, self.terminal_buffer)
 		self.run_remote_button.connect("clicked", self.run_remote_button_clicked, self.remote_treeview, self.terminal_buffer)
 		self.mkdir_button.connect("clicked", self.mkdir_button_clicked, self.remote_treeview, self.terminal_buffer)
 		self.reset_button.connect("clicked", self.reset_button_clicked, self.remote_treeview, self.terminal_buffer)
 		self.delete_button.connect("clicked", self.delete_button_clicked, self.remote_treeview, self.terminal_buffer)
+		self.backup_button.connect("clicked", self.backup_button_clicked, self.terminal_buffer)
+		self.restore_button.connect("clicked", self.restore_button_clicked, self.remote_treeview, self.terminal_buffer)
 
 		# Clear terminal button
 		hbox = Gtk.HBox()
@@ -336,6 +2170,13 @@ class AppWindow(Gtk.ApplicationWindow):
 		hbox.pack_start(clear_terminal_button, False, False, 0)
 		box_outer.pack_start(hbox, False, False, 0)
 		clear_terminal_button.connect("clicked", self.clear_terminal, self.terminal_buffer)
+		self.capture_check = Gtk.CheckButton.new_with_label("Capture device output")
+		self.capture_check.set_tooltip_text("Keep reading what the device prints, also after RUN and RESET, into log files in logs/.")
+		self.capture_check.connect("toggled", self.on_capture_toggled)
+		hbox.pack_start(self.capture_check, False, False, 12)
+		self.profile_check = Gtk.CheckButton.new_with_label("Profile memory on RUN")
+		self.profile_check.set_tooltip_text("Sample the device heap while RUN executes a script, and save the samples as CSV in profiles/.")
+		hbox.pack_start(self.profile_check, False, False, 0)
 
 		# Recheck the connection of the device after a certain delay time
 		if self.use_timeout:
@@ -349,6 +2190,7 @@ class AppWindow(Gtk.ApplicationWindow):
 			Gtk.main_iteration() 
 
 
+	@traced
 	def select_port_popup(self, button, port_entry):
 		dialog = SelectPortPopUp(self)
 		response = dialog.run()
@@ -361,40 +2203,425 @@ class AppWindow(Gtk.ApplicationWindow):
 		else:
 			dialog.destroy()
 
+	@traced
 	def connect_device(self, button, remote_treeview, terminal_view, terminal_buffer):
 		self.debug_print("Connecting to device...")
-		response = self.check_for_device()
+		self.forget_device()
+		self.end_remote_search()
+		response = self.check_for_device(max_age=0)
 		if response == 0:
 			self.debug_print("Connected")
-			self.populate_remote_tree_model(remote_treeview)
+			if not self.show_cached_remote_tree(remote_treeview):
+				self.populate_remote_tree_model(remote_treeview)
 			self.print_and_terminal(terminal_buffer,
 									"Connected to device {}\nHello world!! :)".format(self.ampy_args[0]),
 									MsgType.INFO)
+			self.update_console()
 			model, paths = self.local_treeview.get_selection().get_selected_rows()
 			if len(paths) > 0:
 				self.put_button.set_sensitive(True)
 
+	@traced
+	def probe_link_button_clicked(self, button, terminal_buffer):
+		""" Tries every baud rate above the configured one with a checksummed echo transfer and remembers the fastest
+		one without errors for this port/device in config.ini.
+		"""
+		if self.check_for_device() != 0:
+			return
+		if not transport_for(self.ampy_args[0]).baud:
+			self.print_and_terminal(terminal_buffer, "The link to {} has no baud rate to probe".format(self.ampy_args[0]),
+									MsgType.WARNING)
+			return
+		base = int(self.ampy_args[1])
+		candidates = [int(rate) for rate in self.baud_rates if int(rate) > base]
+		self.print_and_terminal(terminal_buffer, "Probing link on {}...".format(self.ampy_args[0]), MsgType.INFO)
+		self.force_refresh()
+		results = {}
+		try:
+			with DeviceSession(self.ampy_args[0], self.ampy_args[1], self.ampy_args[2], lock=self.device_lock) as session:
+				helper = self.helper_enabled()
+				if helper:
+					self.ensure_helper(session)
+				results[base] = self.measure_link(session, helper)
+				for rate in candidates:
+					if not session.switch_baud(rate):
+						self.print_and_terminal(terminal_buffer, "{} baud: no link".format(rate), MsgType.WARNING)
+						break
+					results[rate] = self.measure_link(session, helper)
+					self.print_and_terminal(terminal_buffer,
+											"{} baud: {:.0f} bytes/s, {} error(s)".format(rate, *results[rate]),
+											MsgType.INFO)
+					self.force_refresh()
+					if not session.switch_baud(base):
+						self.print_and_terminal(terminal_buffer, "Link lost at {} baud, device was reset".format(rate),
+												MsgType.WARNING)
+						break
+		except (PyboardError, serial.SerialException) as ex:
+			self.print_and_terminal(terminal_buffer, "ERROR: Link probe failed: " + device_error_text(ex), MsgType.ERROR)
+			return
+
+		reliable = [rate for rate, (throughput, errors) in results.items() if errors == 0]
+		if not reliable:
+			self.print_and_terminal(terminal_buffer, "No reliable baud rate found", MsgType.ERROR)
+			return
+		best = max(reliable, key=lambda rate: results[rate][0])
+		if self.device_id is None:
+			# The rate is remembered per device, see get_link_baud()
+			self.print_and_terminal(terminal_buffer,
+									"Fastest reliable rate is {} baud, but it is not remembered: the device ID is only known with the device helper".format(best),
+									MsgType.WARNING)
+			return
+		section = self.link_section()
+		if not self.config.has_section(section):
+			self.config.add_section(section)
+		self.config.set(section, 'link_baud', str(best))
+		self.save_config()
+		self.link_baud_failed = False
+		self.print_and_terminal(terminal_buffer, "Using {} baud for this device from now on".format(best), MsgType.INFO)
+
+	def measure_link(self, session, helper=True, size=1024, rounds=4):
+		""" Echoes random payloads through the device, with the helper's echo() or else LINK_ECHO. Returns (payload bytes
+		per second both ways, error count).
+		"""
+		command = HELPER_IMPORT + "echo({!r})" if helper else LINK_ECHO
+		errors = 0
+		start = time.monotonic()
+		for i in range(rounds):
+			payload = os.urandom(size)
+			try:
+				checksum, echoed = session.call(command.format(payload))
+				if echoed != payload or checksum != hashlib.sha256(payload).hexdigest():
+					errors += 1
+			except (TypeError, ValueError):
+				errors += 1		# a reply that is no (checksum, data) pair
+			except PyboardError:
+				errors += 1
+				if not session.resync():
+					errors += rounds - i - 1
+					break
+		return 2 * size * rounds / (time.monotonic() - start), errors
+
 	def update_ampy_command(self):
 		self.ampy_command = ['ampy', '--port', self.ampy_args[0], '--baud',self.ampy_args[1], '--delay',self.ampy_args[2]]
+		self.forget_device()
+
+	def forget_device(self):
+		""" Drops everything learned about the connected device, e.g. when the port settings change or on (re)connect.
+		"""
+		self.helper_state = None
+		self.device_id = None
+		self.link_baud_failed = False
+		self.manifest = None
+		self.manifest_fresh = False
+		self.listing_cache.clear()
+		self.prefetch_generation += 1	# a prefetch still running is for the old device
+		self.stop_console()
+
+	def save_config(self):
+		with open(os.path.join(self.progpath, 'config.ini'), 'w') as f:
+			self.config.write(f)
+
+	def link_section(self):
+		return "link {} {}".format(self.ampy_args[0], self.device_id)
+
+	def get_link_baud(self):
+		""" Returns the fastest reliable baud rate found by the link probe for the connected port/device, if any.
+		"""
+		if self.device_id is None or self.link_baud_failed:
+			return None
+		return self.config.get(self.link_section(), 'link_baud', fallback=None)
+
+	def open_session(self, reboot=True):
+		""" A session on the device port. While the device output is captured, it never soft resets the board, which would
+		restart the program being captured.
+		"""
+		return DeviceSession(self.ampy_args[0], self.ampy_args[1], self.ampy_args[2], link_baud=self.get_link_baud(),
+							 lock=self.device_lock, timeout=self.deadline, min_rate=self.min_rate,
+							 on_timeout=self.record_timeout, reboot=reboot and self.capture is None)
+
+	def record_timeout(self, operation, seconds, received, recovery):
+		self.timeout_stats.record(operation, seconds, received, recovery)
+		tracer.instant("timeout", "device", operation=operation, recovery=recovery)
+		self.manifest_fresh = False		# the operation may have left a partial file behind
+		self.listing_cache.clear()
+		self.print_and_terminal(self.terminal_buffer,
+								"'{}' timed out after {:.0f}s and was stopped by {}. {}".format(
+									operation, seconds, recovery, self.timeout_stats.summary()),
+								MsgType.WARNING)
+
+	def interrupt_device(self):
+		""" Stops whatever runs on the device after an ampy command passed its deadline. Entering the raw REPL sends
+		Ctrl-C and soft resets the board; if that fails, the board is hard reset. Returns how it was stopped.
+		"""
+		try:
+			with DeviceSession(self.ampy_args[0], self.ampy_args[1], self.ampy_args[2], lock=self.device_lock):
+				return "soft reset"
+		except (PyboardError, serial.SerialException):
+			pass
+		try:
+			if transport_for(self.ampy_args[0]).hard_reset(self.ampy_args[0], self.ampy_args[1]):
+				return "hard reset"
+		except serial.SerialException:
+			pass
+		return "nothing, device lost"
+
+	def manifest_dir(self):
+		return os.path.join(self.progpath, "cache", "manifests")
+
+	def current_manifest(self):
+		""" Returns the manifest of the connected device, or None while its ID is unknown.
+		"""
+		if self.device_id is None:
+			return None
+		if self.manifest is None or self.manifest.device_id != self.device_id:
+			self.manifest = RemoteManifest(self.manifest_dir(), self.device_id)
+			self.manifest_fresh = False
+			RemoteManifest.remember_device(self.manifest_dir(), self.ampy_args[0], self.device_id)
+		return self.manifest
+
+	def remote_changed(self, forget=(), hashes=None):
+		""" Records a change made on the device by ampy-gui itself in the manifest: the current listing is kept up to
+		date, but the device stamp no longer matches. hashes are sha256 of files that were just written.
+		"""
+		# Paths in expanded subtrees also change the listing of their parent directory
+		parents = {path.rsplit("/", 1)[0] for path in forget}
+		parents.discard(self.current_remote_path)
+		for path in forget:
+			self.listing_cache.forget(path)
+			if self.remote_treeview is not None and path.startswith(self.current_remote_path + "/"):
+				self.remote_tree_invalidate(self.remote_treeview, path[len(self.current_remote_path) + 1:])
+		self.listing_cache.forget(self.current_remote_path)
+		for path in parents:
+			self.listing_cache.forget(path)
+		manifest = self.current_manifest()
+		if manifest is None:
+			return
+		manifest.stamp = None
+		for path in parents:
+			manifest.listings.pop(manifest.key(path), None)
+		for path in forget:
+			manifest.forget(path)
+		if hashes:
+			manifest.hashes.update({manifest.key(path): digest for path, digest in hashes.items()})
+		manifest.set_listing(self.current_remote_path, self.remote_index)
+		manifest.save()
+
+	def show_cached_remote_tree(self, remote_treeview):
+		""" Shows the manifest listing of the device last seen on this port, marked as cached, and verifies it in the
+		background, unless that would interrupt the program whose output is captured. Returns False if there is nothing
+		cached to show.
+		"""
+		if not self.helper_enabled():
+			return False
+		device_id = RemoteManifest.last_device(self.manifest_dir(), self.ampy_args[0])
+		if device_id is None:
+			return False
+		manifest = RemoteManifest(self.manifest_dir(), device_id)
+		entries = manifest.listing(self.current_remote_path)
+		if entries is None:
+			return False
+		self.manifest = manifest
+		self.show_remote_entries(entries)
+		self.fill_remote_treeview(remote_treeview)
+		self.set_remote_stale(True)
+		if self.capture is None:
+			Thread(target=self.verify_manifest,
+				   args=(remote_treeview, manifest, self.ampy_args[0], self.current_remote_path), daemon=True).start()
+		return True
+
+	def verify_manifest(self, remote_treeview, manifest, port, path):
+		""" Runs in the background: compares the device's stamp with the manifest and fetches a fresh listing of path
+		if they differ (or if another device turned up on the port). Everything it learns is applied on the main thread.
+		"""
+		entries = None
+		try:
+			with self.open_session() as session:
+				device_id = self.install_helper(session)
+				if device_id != manifest.device_id:
+					manifest = RemoteManifest(self.manifest_dir(), device_id)
+				stamp = session.call(HELPER_IMPORT + "stamp()")
+				if stamp != manifest.stamp or manifest.listing(path) is None:
+					entries = session.call(HELPER_IMPORT + "ls({!r})".format(path))
+		except HelperUnavailable as ex:
+			GLib.idle_add(self.helper_failed, ex)
+			return
+		except (PyboardError, serial.SerialException) as ex:
+			self.print_and_terminal(self.terminal_buffer, "ERROR: " + device_error_text(ex), MsgType.ERROR)
+			return
+		GLib.idle_add(self.apply_manifest_check, remote_treeview, manifest, port, path, device_id, stamp, entries)
+
+	def apply_manifest_check(self, remote_treeview, manifest, port, path, device_id, stamp, entries):
+		if port != self.ampy_args[0]:
+			return False
+		if self.helper_state is None:
+			self.helper_ready(device_id)
+		if manifest.device_id != self.device_id:
+			return False
+		if stamp != manifest.stamp:
+			self.debug_print("Device changed since last connect, refreshing")
+			manifest.clear()
+			manifest.stamp = stamp
+		if entries is not None:
+			manifest.set_listing(path, entries)
+			if self.current_remote_path == path:
+				self.show_remote_entries(entries)
+				self.fill_remote_treeview(remote_treeview)
+		manifest.save()
+		self.manifest = manifest
+		self.manifest_fresh = True
+		RemoteManifest.remember_device(self.manifest_dir(), self.ampy_args[0], self.device_id)
+		self.set_remote_stale(False)
+		return False
+
+	def set_remote_stale(self, stale):
+		self.remote_column.set_title("Remote File Browser (cached)" if stale else "Remote File Browser")
+
+	def local_index(self, root=None):
+		""" Returns the (cached) LocalIndex of a local directory, current_local_path by default.
+		"""
+		root = os.path.abspath(root or self.current_local_path)
+		if root not in self.local_indexes:
+			self.local_indexes[root] = LocalIndex(root, os.path.join(self.progpath, "cache", "local"))
+		return self.local_indexes[root]
+
+	def run_ampy(self, args, payload=0):
+		""" Runs an ampy command line, holding the port so it doesn't interleave with background device sessions.
+		The command gets the deadline of a device operation that moves payload bytes; past it, ampy is killed and the
+		device interrupted. 'ampy run' waits for the script, which may run as long as it likes, so it has no deadline.
+		"""
+		if not transport_for(self.ampy_args[0]).ampy:
+			error = "ampy can only reach serial ports, {} needs the device helper".format(self.ampy_args[0])
+			return subprocess.CompletedProcess(self.ampy_command + args, 1, b'', error.encode("UTF-8"))
+		timeout = self.deadline + payload / self.min_rate
+		if args[0] == 'run' and '--no-output' not in args:
+			timeout = None
+		with self.device_lock:
+			try:
+				with tracer.span("ampy " + args[0], "ampy", args=args[1:]):
+					return subprocess.run(self.ampy_command + args, capture_output=True, timeout=timeout)
+			except subprocess.TimeoutExpired:
+				recovery = self.interrupt_device()
+		self.record_timeout(args[0], timeout, 0, recovery)
+		error = "'ampy {}' timed out after {:.0f}s".format(args[0], timeout)
+		return subprocess.CompletedProcess(self.ampy_command + args, 1, b'', error.encode("UTF-8"))
+
+	def helper_enabled(self):
+		return self.use_helper and self.helper_state is not False
+
+	def ensure_helper(self, session):
+		""" Makes sure the resident helper module on the device matches util/ampygui_helper.py, (re)installing it if its
+		checksum differs, and returns the device ID. The check is only done once per connection, or once per session
+		in other threads, which leave the state of the window to the main thread.
+		"""
+		main = current_thread() is main_thread()
+		if session.link_failed:
+			if main:
+				self.link_failed(session.link_baud, session.baud)
+			else:
+				GLib.idle_add(self.link_failed, session.link_baud, session.baud)
+		if self.helper_state:
+			return self.device_id
+		if session.helper_id is not None:
+			return session.helper_id
+		try:
+			device_id = self.install_helper(session)
+		except HelperUnavailable as ex:
+			if main:
+				self.helper_failed(ex)
+			else:
+				GLib.idle_add(self.helper_failed, ex)
+			raise
+		session.helper_id = device_id
+		if main:
+			self.helper_ready(device_id)
+		else:
+			GLib.idle_add(self.helper_ready, device_id, session.port)
+		return device_id
+
+	def link_failed(self, link_baud, baud):
+		if not self.link_baud_failed:
+			self.link_baud_failed = True
+			self.print_and_terminal(self.terminal_buffer,
+									"Could not switch to {} baud, using {} baud for this connection".format(link_baud, baud),
+									MsgType.WARNING)
+		return False
+
+	def install_helper(self, session):
+		""" The work of ensure_helper(), without touching the state of the window, so background threads can use it
+		and hand the result to helper_ready() or helper_failed() on the main thread. Returns the device ID, raises
+		HelperUnavailable if the helper could not be installed.
+		"""
+		with open(os.path.join(self.progpath, "util", "ampygui_helper.py"), "rb") as f:
+			source = f.read()
+		checksum = hashlib.sha256(source).hexdigest()
+		installed = session.call("try:\n import ampygui_helper as _h\n print(repr((_h.VERSION,_h._sha256({!r}),_h._uid())))\n"
+								 "except Exception:\n print(repr(None))".format(HELPER_FILE))
+		if installed is not None and installed[1] == checksum:
+			return installed[2]
+		self.debug_print("Installing device helper (installed version: {})".format(installed and installed[0]))
+		try:
+			session.write_file(HELPER_FILE, io.BytesIO(source))
+			session.exec("import sys\nsys.modules.pop('ampygui_helper', None)")
+			return session.call(HELPER_IMPORT + "uid()")
+		except PyboardError as ex:
+			raise HelperUnavailable(device_error_text(ex)) from ex
+
+	def helper_ready(self, device_id, port=None):
+		""" Runs on the main thread. With port, as handed over by a background thread, it is ignored if the port has
+		changed since.
+		"""
+		if port is None or port == self.ampy_args[0]:
+			self.device_id = device_id
+			self.helper_state = True
+		return False
+
+	def helper_failed(self, ex):
+		self.helper_state = False
+		self.print_and_terminal(self.terminal_buffer,
+								"ERROR: Could not install the device helper, using ampy from now on: " + device_error_text(ex),
+								MsgType.ERROR)
+		return False
+
+	def helper_call(self, command, session=None):
+		""" Runs a one-line call against the device helper, e.g. "ls('/lib')", and returns the parsed reply.
+		Raises PyboardError (or serial.SerialException) when the device could not execute the call.
+		"""
+		if session is None:
+			with self.open_session() as session:
+				return self.helper_call(command, session)
+		self.ensure_helper(session)
+		return session.call(HELPER_IMPORT + command)
 
 	def recheck_connection(self):
 		""" Checks if the connected device is still available
 		"""
 		self.debug_print("Rechecking connection...")
 		if self.connected:
-			self.check_for_device()
+			self.check_for_device(max_age=0)
 		else:
 			self.debug_print("No active device")
 		return True		# Necessary for the GLib timeout to keep running
 
-	def check_for_device(self):
+	def check_for_device(self, max_age=None):
+		""" Checks whether the device can be reached, returns 0 if it can. A successful check at most max_age seconds
+		old (check_interval by default) is reused instead of opening the port again.
+		"""
+		if max_age is None:
+			max_age = self.check_interval
+		if self.connected and time.monotonic() - self.last_check < max_age:
+			return 0
+		if self.connected and self.repl_console is not None and self.repl_console.running():
+			# Opening the port again could reset the board through DTR/RTS, the console reports a lost port anyway
+			self.last_check = time.monotonic()
+			return 0
 		try:
-			port = serial.Serial(port=self.ampy_args[0])
-			if port.isOpen():
-				self.enable_remote_buttons(True)
-				self.connected = True
-				return 0
+			transport_for(self.ampy_args[0]).probe(self.ampy_args[0])
+			self.enable_remote_buttons(True)
+			self.connected = True
+			self.last_check = time.monotonic()
+			return 0
 		except serial.SerialException as ex:
+			self.last_check = 0
 			if self.connected:
 				self.print_and_terminal(self.terminal_buffer, "Device disconnected", MsgType.WARNING)
 			self.connected = False
@@ -416,16 +2643,35 @@ class AppWindow(Gtk.ApplicationWindow):
 			self.put_button.set_sensitive(False)
 			return -1
 		
+	def schedule_device_check(self):
+		""" Throttles device checks triggered by UI events: the first event schedules a check check_interval later, and
+		the events until then share it, so there is at most one check per check_interval.
+		"""
+		if self.pending_check is None:
+			self.pending_check = GLib.timeout_add(int(self.check_interval * 1000), self.run_scheduled_check)
+
+	def run_scheduled_check(self):
+		self.pending_check = None
+		if self.connected:
+			self.check_for_device()
+		return False
+
+	@traced
 	def on_port_change(self,port,event):
+		if port.get_text() == self.ampy_args[0]:
+			return
 		self.ampy_args[0]=port.get_text()
-		if self.check_for_device() != -1:
-			self.update_ampy_command()
-			self.debug_print("Port Changed")
+		# Sessions and ampy use the new port from now on, whether the device answers there or not
+		self.update_ampy_command()
+		self.debug_print("Port Changed")
+		self.check_for_device(max_age=0)
+	@traced
 	def on_baud_change(self,baud):
 		selected = baud.get_active()
 		self.ampy_args[1]= self.baud_rates[selected]
 		self.update_ampy_command()
 		self.debug_print("Baud Changed")
+	@traced
 	def on_delay_change(self,delay):
 		value = delay.get_value()
 		self.ampy_args[2]=str(value)
@@ -449,6 +2695,7 @@ class AppWindow(Gtk.ApplicationWindow):
 	def setup_remote_tree_view(self, remote_treeview):
 		column = Gtk.TreeViewColumn.new()
 		column.set_title("Remote File Browser")
+		self.remote_column = column
 
 		renderer = Gtk.CellRendererPixbuf.new()
 		column.pack_start(renderer, False)
@@ -475,7 +2722,7 @@ class AppWindow(Gtk.ApplicationWindow):
 		self.populate_local_tree_model(local_treeview)
 
 	def setup_remote_tree_model(self, remote_treeview):
-		remote_store = Gtk.ListStore(GdkPixbuf.Pixbuf, GObject.TYPE_STRING, GObject.TYPE_STRING)
+		remote_store = Gtk.TreeStore(GdkPixbuf.Pixbuf, GObject.TYPE_STRING, GObject.TYPE_STRING, GObject.TYPE_STRING)
 		remote_treeview.set_model(remote_store)
 
 	def populate_local_tree_model(self, local_treeview):
@@ -487,42 +2734,49 @@ class AppWindow(Gtk.ApplicationWindow):
 
 		# Add the '..' directory
 		iterator = store.append()
-		pixbuf = GdkPixbuf.Pixbuf.new_from_file(os.path.join(self.progpath, "directory.png"))
-		store.set(iterator, self.ICON, pixbuf, self.FILENAME, "..")
+		store.set(iterator, self.ICON, self.pixbuf('d'), self.FILENAME, "..")
 
 		# Parse through the directory, adding all of its contents to the model.
 		filelst = os.listdir(self.current_local_path)
 		filelst.sort(key=lambda v: (v.upper(), v))
 		for file in filelst:
-			if file in ignore_files:
+			if ignored(file):
 				continue
 			temp = os.path.join(self.current_local_path, file)
 			if os.path.isdir(temp):
-				pixbuf = GdkPixbuf.Pixbuf.new_from_file(os.path.join(self.progpath, "directory.png"))
 				iterator = store.append()
-				store.set(iterator, self.ICON, pixbuf, self.FILENAME, file)
+				store.set(iterator, self.ICON, self.pixbuf('d'), self.FILENAME, file)
 
 		for file in filelst:
-			if file in ignore_files:
+			if ignored(file):
 				continue
 			temp = os.path.join(self.current_local_path, file)
 			if os.path.isfile(temp):
-				pixbuf = GdkPixbuf.Pixbuf.new_from_file(os.path.join(self.progpath, "file.png"))
 				iterator = store.append()
-				store.set(iterator, self.ICON, pixbuf, self.FILENAME, file)
+				store.set(iterator, self.ICON, self.pixbuf('f'), self.FILENAME, file)
 
 		local_treeview.columns_autosize()
 
 		if self.put_button:
 			self.put_button.set_sensitive(False)
 
-	def populate_remote_tree_model(self, remote_treeview):
+	def populate_remote_tree_model(self, remote_treeview, cached=False):
+		""" Lists the current remote directory. With cached, the manifest listing is used when the manifest is known
+		to match the device.
+		"""
 		self.debug_print("Populating remote tree model")
 
-		self.remote_dirs.clear()
-		self.remote_files.clear()
-
-		if self.current_remote_path.strip("/") == "":
+		entries = None
+		if self.helper_enabled():
+			try:
+				entries = self.remote_listing(self.current_remote_path, cached)
+			except HelperUnavailable:
+				pass	# already reported, list with ampy instead
+		if entries is not None:
+			self.show_remote_entries(entries)
+			self.set_remote_stale(False)
+			self.schedule_prefetch(remote_treeview)
+		elif self.current_remote_path.strip("/") == "":
 			# Much faster method, but only works for the root directory...
 
 			## Fetch the files
@@ -534,60 +2788,230 @@ class AppWindow(Gtk.ApplicationWindow):
 			self.debug_print(f"Remote directories fetched: {str(directories)}")
 
 			# Add the directories and files to the treeview
+			entries = []
 			if directories:
-				for d in directories:
-					if d == '': continue
-					self.remote_dirs.append(d)
+				entries += [(d, 'd', 0) for d in directories if d != '']
 			if files:
-				for f in files:
-					if f == '': continue
-					self.remote_files.append(f)
+				entries += [(f, 'f', 0) for f in files if f != '']
+			self.show_remote_entries(entries)
 		else:
 			# Much slower method, but works for sub-directories of root...
 
 			## Get all the files and directories from remote
-			nondirs = []
+			entries = []
 			filelist=self.load_remote_directory(self.current_remote_path)
 			for f in filelist:
 				if self.is_remote_dir(self.current_remote_path+'/'+f):
-					self.remote_dirs.append(f)
+					entries.append((f, 'd', 0))
 				else:
-					nondirs.append(f)
-			for f in range(len(nondirs)):
-				self.remote_files.append(nondirs[f])
+					entries.append((f, 'f', 0))
+			self.show_remote_entries(entries)
 
 		self.fill_remote_treeview(remote_treeview)
 
+	def remote_listing(self, path, cached=True):
+		""" Returns the entries of a remote directory. With cached, a known listing is used instead of asking the device:
+		the manifest's when it is known to match the device, or a prefetched one.
+		"""
+		entries = None
+		manifest = self.current_manifest()
+		if cached and self.manifest_fresh and manifest is not None:
+			entries = manifest.listing(path)
+		if cached and entries is None:
+			entries = self.listing_cache.get(path)
+		if entries is None:
+			entries = self.fetch_remote_listing(path)
+		return entries
+
+	def fetch_remote_listing(self, path):
+		""" Lists path with a single helper call and records the listing in the device manifest.
+		"""
+		try:
+			with self.open_session() as session:
+				# One short call returns names, types and sizes of the whole directory
+				entries = self.helper_call("ls({!r})".format(path), session)
+				manifest = self.current_manifest()
+				if manifest is not None and manifest.stamp is None and not manifest.listings:
+					# First listing of this device, so the stamp is consistent with everything in the manifest
+					manifest.stamp = self.helper_call("stamp()", session)
+					self.manifest_fresh = True
+		except HelperUnavailable:
+			raise
+		except (PyboardError, serial.SerialException) as ex:
+			self.print_and_terminal(self.terminal_buffer, "ERROR: " + device_error_text(ex), MsgType.ERROR)
+			return []
+		self.debug_print(f"Remote entries fetched: {str(entries)}")
+		if manifest is not None:
+			manifest.set_listing(path, entries)
+			manifest.save()
+		return entries
+
+	def schedule_prefetch(self, remote_treeview, delay=500):
+		""" Prefetches the sub-directories of the current remote directory once the view was idle for delay ms.
+		"""
+		self.prefetch_generation += 1
+		GLib.timeout_add(delay, self.start_prefetch, remote_treeview, self.prefetch_generation)
+
+	def start_prefetch(self, remote_treeview, generation):
+		if (generation != self.prefetch_generation or self.remote_search_active or not self.helper_enabled()
+				or self.capture is not None):
+			return False
+		directories = [name for name, ftype, size in self.remote_index if ftype == 'd']
+		# Selected directories first, then the visible ones, then the rest
+		model, rows = remote_treeview.get_selection().get_selected_rows()
+		selected = {model.get_value(model.get_iter(row), self.FILENAME) for row in rows}
+		visible = remote_treeview.get_visible_range()
+		if visible is not None:
+			first, last = visible[0].get_indices()[0] - 1, visible[1].get_indices()[0] - 1	# row 0 is '..'
+		else:
+			first, last = 0, len(directories)
+		directories.sort(key=lambda name: (name not in selected, not first <= self.remote_index.position(name) <= last))
+		manifest = self.current_manifest() if self.manifest_fresh else None
+		paths = [self.current_remote_path + "/" + name for name in directories]
+		paths = [path for path in paths if path not in self.listing_cache
+				 and (manifest is None or manifest.listing(path) is None)]
+		if paths:
+			Thread(target=self.prefetch_listings, args=(paths, generation), daemon=True).start()
+		return False
+
+	def prefetch_listings(self, paths, generation):
+		""" Runs in the background: lists paths, in order, into the listing cache over one session, which does not soft
+		reset the device. Only starts while nobody else uses the port, and gives it up as soon as a user operation
+		waits for it, or when another directory gets listed.
+		"""
+		if not self.device_lock.take(0):
+			return
+		try:
+			with self.open_session(reboot=False) as session:
+				session.cancel = self.device_lock.contended
+				for path in paths:
+					if generation != self.prefetch_generation or self.device_lock.contended():
+						return
+					entries = self.helper_call("ls({!r})".format(path), session)
+					if generation == self.prefetch_generation:
+						self.listing_cache.put(path, entries)
+					self.debug_print("Prefetched '{}'".format(path))
+		except (PyboardError, serial.SerialException):
+			pass	# only speculative, the listing is fetched again when the user opens the directory
+		finally:
+			self.device_lock.release()
+
+	def show_remote_entries(self, entries):
+		self.remote_index.replace(entries)
+
+	def pixbuf(self, ftype):
+		""" Returns the (shared) icon for a directory ('d') or file ('f') row.
+		"""
+		if ftype not in self.pixbufs:
+			icon = "directory.png" if ftype == 'd' else "file.png"
+			self.pixbufs[ftype] = GdkPixbuf.Pixbuf.new_from_file(os.path.join(self.progpath, icon))
+		return self.pixbufs[ftype]
+
 	def fill_remote_treeview(self, remote_treeview):
-		# Clear the treeview
+		""" Rebuilds the remote treeview from the remote index, e.g. after navigating to another directory. Single
+		changes go through remote_tree_add() and remote_tree_remove() instead.
+		"""
 		remote_store = remote_treeview.get_model()
+		# Detach the model while refilling, so the view doesn't update for every row
+		remote_treeview.set_model(None)
 		remote_store.clear()
 
-		# Make sure the files are sorted alphabetically
-		self.remote_dirs.sort(key=lambda v: (v.upper(), v))
-		self.remote_files.sort(key=lambda v: (v.upper(), v))
-
 		# Add '..' to directory
-		iterator = remote_store.append()
-		pixbuf = GdkPixbuf.Pixbuf.new_from_file(os.path.join(self.progpath, "directory.png"))
-		remote_store.set(iterator, self.ICON, pixbuf, self.FILENAME, "..", self.TYPE, 'd')
+		remote_store.insert(None, -1, [self.pixbuf('d'), "..", 'd', ".."])
 
-		# Fill the treeview with the directories and files
-		for d in self.remote_dirs:
-			iterator = remote_store.append()
-			pixbuf = GdkPixbuf.Pixbuf.new_from_file(os.path.join(self.progpath, "directory.png"))
-			remote_store.set(iterator, self.ICON, pixbuf, self.FILENAME, d, self.TYPE, 'd')
-		for f in self.remote_files:
-			iterator = remote_store.append()
-			pixbuf = GdkPixbuf.Pixbuf.new_from_file(os.path.join(self.progpath, "file.png"))
-			remote_store.set(iterator, self.ICON, pixbuf, self.FILENAME, f, self.TYPE, 'f')
+		# Fill the treeview with the directories and files, the index keeps them sorted
+		for name, ftype, size in self.remote_index:
+			self.insert_remote_row(remote_store, None, -1, name, ftype, name)
 
+		remote_treeview.set_model(remote_store)
 		remote_treeview.columns_autosize()
 		self.enable_remote_file_buttons(False)
 
+	def insert_remote_row(self, remote_store, parent, position, name, ftype, path):
+		""" Inserts a remote treeview row. Directories get a placeholder child, so they can be expanded and are only
+		listed when they are.
+		"""
+		row = remote_store.insert(parent, position, [self.pixbuf(ftype), name, ftype, path])
+		if ftype == 'd':
+			remote_store.insert(row, -1, [None, "", "", ""])
+		return row
+
+	def find_remote_row(self, remote_store, path):
+		""" Returns the iter of the loaded row at path (relative to current_remote_path), or None.
+		"""
+		row = None
+		for depth in range(path.count("/") + 1):
+			prefix = "/".join(path.split("/")[:depth + 1])
+			child = remote_store.iter_children(row)
+			while child is not None and remote_store.get_value(child, self.PATH) != prefix:
+				child = remote_store.iter_next(child)
+			if child is None:
+				return None
+			row = child
+		return row
+
+	@traced
+	def on_remote_row_expand(self, remote_treeview, row, tree_path):
+		""" Lists a directory the first time its row is expanded. Loaded subtrees are kept when collapsed.
+		"""
+		remote_store = remote_treeview.get_model()
+		placeholder = remote_store.iter_children(row)
+		if placeholder is None or remote_store.get_value(placeholder, self.TYPE) != "":
+			return False
+		path = remote_store.get_value(row, self.PATH)
+		if not self.helper_enabled():
+			return True		# the ampy listing is far too slow to load whole subtrees, browse into the directory instead
+		try:
+			entries = RemoteIndex(self.remote_listing(self.current_remote_path + "/" + path))
+		except HelperUnavailable:
+			return True
+		for name, ftype, size in entries:
+			self.insert_remote_row(remote_store, row, -1, name, ftype, path + "/" + name)
+		remote_store.remove(placeholder)
+		return not len(entries)
+
+	def remote_tree_invalidate(self, remote_treeview, path):
+		""" Drops the loaded contents of the directory row at path, so it is listed again on the next expand.
+		"""
+		remote_store = remote_treeview.get_model()
+		row = self.find_remote_row(remote_store, path)
+		if row is None or remote_store.get_value(row, self.TYPE) != 'd':
+			return
+		remote_treeview.collapse_row(remote_store.get_path(row))
+		child = remote_store.iter_children(row)
+		while child is not None:
+			remote_store.remove(child)
+			child = remote_store.iter_children(row)
+		remote_store.insert(row, -1, [None, "", "", ""])
+
+	def remote_tree_add(self, remote_treeview, name, ftype, size=0):
+		""" Adds (or updates) a single entry in the remote index and inserts its row in the treeview.
+		"""
+		if name in self.remote_index and self.remote_index.get(name)[0] != ftype:
+			self.remote_tree_remove(remote_treeview, name)
+		position = self.remote_index.add(name, ftype, size)
+		if position is not None:
+			# Row 0 is '..'
+			self.insert_remote_row(remote_treeview.get_model(), None, position + 1, name, ftype, name)
+
+	def remote_tree_remove(self, remote_treeview, name):
+		""" Removes a single entry from the remote index and its row from the treeview. name may also be the path of
+		a row in an expanded subtree.
+		"""
+		remote_store = remote_treeview.get_model()
+		if "/" in name:
+			row = self.find_remote_row(remote_store, name)
+			if row is not None:
+				remote_store.remove(row)
+			return
+		if name not in self.remote_index:
+			return
+		position = self.remote_index.remove(name)
+		remote_store.remove(remote_store.iter_nth_child(None, position + 1))
+
 	def is_remote_dir(self, path):
 		args=['ls',path]
-		output=subprocess.run(self.ampy_command + args,capture_output=True)
+		output=self.run_ampy(args)
 		if output.returncode == 0:
 			return True
 		else:
@@ -602,7 +3026,7 @@ class AppWindow(Gtk.ApplicationWindow):
 		run_file = os.path.join(
 			os.path.join(self.progpath, "util", "print_files.py"))
 		args = ['run', run_file]
-		output = subprocess.run(self.ampy_command + args, capture_output=True)
+		output = self.run_ampy(args)
 		if output.returncode == 0:
 			files = output.stdout.decode("UTF-8").split("\r\n")
 			files.sort(key=lambda v: (v.upper(), v))  # Make sure the files are sorted alphabetically
@@ -621,7 +3045,7 @@ class AppWindow(Gtk.ApplicationWindow):
 		run_file = os.path.join(
 			os.path.join(self.progpath, "util", "print_directories.py"))
 		args = ['run', run_file]
-		output = subprocess.run(self.ampy_command + args, capture_output=True)
+		output = self.run_ampy(args)
 		if output.returncode == 0:
 			directories = output.stdout.decode("UTF-8").split("\r\n")
 			directories.sort(key=lambda v: (v.upper(), v))  # Make sure the directories are sorted alphabetically
@@ -635,7 +3059,7 @@ class AppWindow(Gtk.ApplicationWindow):
 		response=self.check_for_device()
 		if response == 0:
 			args=['ls', path]
-			output=subprocess.run(self.ampy_command + args, capture_output=True)
+			output=self.run_ampy(args)
 			if output.stderr.decode("utf-8") == "":
 				filestring = output.stdout.decode("utf-8")
 				filelist = filestring.split('\n')
@@ -656,8 +3080,10 @@ class AppWindow(Gtk.ApplicationWindow):
 			files = []
 			for fpath in paths:
 				iterator = model.get_iter(fpath)
-				fname = model.get_value(iterator, self.FILENAME)
+				fname = model.get_value(iterator, self.PATH)
 				ftype = model.get_value(iterator, self.TYPE)
+				if ftype == "":
+					continue	# placeholder of a directory that is being loaded
 				file = (fname, ftype)
 				files.append(file)
 			return files
@@ -677,6 +3103,7 @@ class AppWindow(Gtk.ApplicationWindow):
 		else:
 			return None
 
+	@traced
 	def get_button_clicked(self,button, local_treeview, remote_treeview, terminal_buffer):
 		""" Retrieves a file from the remote device
 		"""
@@ -689,19 +3116,74 @@ class AppWindow(Gtk.ApplicationWindow):
 										MsgType.WARNING)
 				return
 			else:
-				for row_selected in rows_selected:
-					fname, ftype = row_selected
-					if ftype == 'f':
-						os.chdir(self.current_local_path)
-						self.get_file(local_treeview, terminal_buffer,
-										self.current_remote_path + "/" + fname,
-									   	os.path.join(self.current_local_path, fname))
+				if self.helper_enabled():
+					self.download_remote_entries(rows_selected, terminal_buffer)
+				else:
+					for row_selected in rows_selected:
+						fname, ftype = row_selected
+						if ftype == 'f':
+							self.get_file(local_treeview, terminal_buffer,
+											self.current_remote_path + "/" + fname,
+											os.path.join(self.current_local_path, os.path.basename(fname)),
+											size=(self.remote_index.get(fname) or (ftype, 0))[1])
 				self.populate_local_tree_model(local_treeview)
 
-	def get_file(self, local_treeview, terminal_buffer, src_remote_file, dest_local_file, print=True):
+	def download_remote_entries(self, rows_selected, terminal_buffer):
+		""" Downloads the selected remote files, and directories recursively, into current_local_path over a single
+		device session. Every file is streamed straight to disk.
+		"""
+		try:
+			with self.open_session() as session:
+				for fname, ftype in rows_selected:
+					if fname == "..":
+						continue
+					remote_path = self.current_remote_path + "/" + fname
+					local_path = os.path.join(self.current_local_path, os.path.basename(fname))
+					if ftype == 'd':
+						# One call returns the whole tree below the directory
+						stamp, found = self.helper_call("find({!r})".format(remote_path), session)
+						os.makedirs(local_path, exist_ok=True)
+						files = 0
+						for path, entry_type, size in found:
+							target = os.path.join(local_path, *path[len(remote_path):].strip("/").split("/"))
+							if entry_type == 'd':
+								os.makedirs(target, exist_ok=True)
+							else:
+								self.download_file(session, path, target)
+								files += 1
+						self.print_and_terminal(terminal_buffer,
+												"Directory '{}' ({} file(s)) successfully fetched from device".format(remote_path, files),
+												MsgType.INFO)
+					else:
+						self.download_file(session, remote_path, local_path)
+						self.print_and_terminal(terminal_buffer,
+												"File '{}' successfully fetched from device".format(remote_path),
+												MsgType.INFO)
+		except (PyboardError, serial.SerialException, OSError) as ex:
+			self.print_and_terminal(terminal_buffer, "Error fetching file from device: " + device_error_text(ex), MsgType.ERROR)
+
+	def download_file(self, session, remote_path, local_path):
+		""" Downloads into local_path + PART_SUFFIX, which is renamed to local_path once complete. When such a part is
+		left over from an interrupted download and matches the start of the remote file, only the rest is fetched.
+		"""
+		self.debug_print("Fetching '{}'".format(remote_path))
+		self.ensure_helper(session)
+		part = local_path + PART_SUFFIX
+		offset = os.path.getsize(part) if os.path.isfile(part) else 0
+		if offset and self.helper_call("sha({!r},{})".format(remote_path, offset), session) != hash_local_file(part):
+			offset = 0
+		if offset:
+			self.debug_print("Resuming '{}' at {} bytes".format(remote_path, offset))
+		with open(part, "ab" if offset else "wb") as f:
+			session.read_file(remote_path, f, offset=offset)
+		os.replace(part, local_path)
+
+	def get_file(self, local_treeview, terminal_buffer, src_remote_file, dest_local_file, print=True, size=0):
 		args = ['get', src_remote_file, dest_local_file]
-		output = subprocess.run(self.ampy_command + args, capture_output=True)
+		output = self.run_ampy(args, size)
 		if output.returncode == 0:
+			if os.path.isfile(dest_local_file + PART_SUFFIX):
+				os.remove(dest_local_file + PART_SUFFIX)	# left over from an interrupted download through the helper
 			if print:
 				self.print_and_terminal(terminal_buffer,
 									"File '{}' successfully fetched from device".format(src_remote_file),
@@ -712,6 +3194,7 @@ class AppWindow(Gtk.ApplicationWindow):
 									"Error fetching file from device: '{}'".format(output.stderr.decode("utf-8"),
 																				   MsgType.ERROR))
 
+	@traced
 	def put_button_clicked(self, button, local_treeview, remote_treeview, terminal_buffer):
 		""" Uploads a file to the remote device
 		"""
@@ -722,31 +3205,130 @@ class AppWindow(Gtk.ApplicationWindow):
 				self.print_and_terminal(terminal_buffer,
 										"No file selected", MsgType.WARNING)
 				return
+			elif self.helper_enabled():
+				self.upload_local_entries(files_selected, remote_treeview, terminal_buffer, pack=self.pack_check.get_active())
 			else:
+				local_index = self.local_index()
+				hashes = {}
+				dirs = []		# directories that were (over)written, their known listings are outdated
 				for file in files_selected:
 					source = os.path.join(self.current_local_path, file)
 					dest = self.current_remote_path + '/' + file
 		
 					args = ['put', source, dest]
-					output = subprocess.run(self.ampy_command + args, capture_output=True)
+					output = self.run_ampy(args, local_size(source))
 					if output.returncode != 0:
 						self.print_and_terminal(terminal_buffer,
 												"Error uploading file from device: '{}'".format(output.stderr.decode("utf-8")),
 												MsgType.ERROR)
+						# It may have been written in part
+						self.remote_changed(forget=dirs + [dest], hashes=hashes)
 						return
 					self.debug_print("File '{}' successfully uploaded to device".format(file))
 
-					if os.path.isdir(source) and not file in self.remote_dirs:
-						self.remote_dirs.append(file)
-					elif os.path.isfile(source) and not file in self.remote_files:
-						self.remote_files.append(file)
-					self.fill_remote_treeview(remote_treeview)
+					if os.path.isdir(source):
+						dirs.append(dest)
+						self.remote_tree_add(remote_treeview, file, 'd')
+					elif os.path.isfile(source):
+						self.remote_tree_add(remote_treeview, file, 'f', os.path.getsize(source))
+						hashes[dest] = local_index.lookup(file)
 
-				self.populate_remote_tree_model(remote_treeview)
+				local_index.save()
+				self.remote_changed(forget=dirs, hashes=hashes)
 				msg = "File(s) '{}' successfully uploaded to remote device".format(", ".join(files_selected))
 				self.print_and_terminal(terminal_buffer, msg, MsgType.INFO)
 
-
+	def upload_local_entries(self, files_selected, remote_treeview, terminal_buffer, pack=False):
+		""" Uploads the selected local files, and directories recursively, into current_remote_path over a single
+		device session. Every file is streamed from disk in fixed-size chunks. With pack, everything goes out as one
+		PackStream that the helper unpacks on the device, which saves the round trips per file.
+		"""
+		local_index = self.local_index()
+		groups = []		# (selected name, [(relative path, size, or None for directories), ...])
+		for file in files_selected:
+			source = os.path.join(self.current_local_path, file)
+			if os.path.isdir(source):
+				entries = [(file, None)]
+				entries += [(rel, None if stat.S_ISDIR(st.st_mode) else st.st_size)
+							for rel, st in local_index.walk(file, dirs=True)]
+				groups.append((file, entries))
+			elif os.path.isfile(source):
+				groups.append((file, [(file, os.path.getsize(source))]))
+
+		uploaded = []
+		try:
+			with self.open_session() as session:
+				self.ensure_helper(session)
+				if pack:
+					stream = PackStream(self.current_local_path, [entry for file, entries in groups for entry in entries])
+					with stream:
+						command = "unpack({!r},{})".format(self.current_remote_path or "/", stream.size)
+						pack = session.send_stream(HELPER_IMPORT + command, stream, stream.size)
+					if stream.changed:
+						raise OSError("'{}' changed while uploading".format(stream.changed[0]))
+					if pack:
+						uploaded = groups
+				if not pack:
+					for file, entries in groups:
+						for rel, size in entries:
+							remote_path = self.current_remote_path + '/' + rel
+							if size is None:
+								self.helper_call("mkdir({!r})".format(remote_path), session)
+							else:
+								self.upload_file(session, os.path.join(self.current_local_path, rel), remote_path)
+						uploaded.append((file, entries))
+		except (PyboardError, serial.SerialException, OSError) as ex:
+			self.print_and_terminal(terminal_buffer, "Error uploading file to device: " + device_error_text(ex), MsgType.ERROR)
+			# The rest may have been written in part
+			failed = [self.current_remote_path + '/' + file for file, entries in groups[len(uploaded):]]
+			if failed:
+				self.remote_changed(forget=failed)
+		if uploaded:
+			hashes = {}
+			dirs = []
+			for file, entries in uploaded:
+				for rel, size in entries:
+					if size is not None:
+						hashes[self.current_remote_path + '/' + rel] = local_index.lookup(rel)
+				if entries[0][1] is None:
+					dirs.append(self.current_remote_path + '/' + file)
+					self.remote_tree_add(remote_treeview, file, 'd')
+				else:
+					self.remote_tree_add(remote_treeview, file, 'f', entries[0][1])
+			local_index.save()
+			self.remote_changed(forget=dirs, hashes=hashes)
+			msg = "File(s) '{}' successfully uploaded to remote device".format(", ".join(file for file, entries in uploaded))
+			self.print_and_terminal(terminal_buffer, msg, MsgType.INFO)
+
+	def upload_file(self, session, local_path, remote_path):
+		""" Uploads a local file over session, returns its size. Large files that already exist on the device only
+		have their changed blocks sent.
+		"""
+		self.debug_print("Uploading '{}'".format(remote_path))
+		self.ensure_helper(session)
+		with open(local_path, "rb") as f:
+			size = os.fstat(f.fileno()).st_size
+			if size >= DELTA_MIN_SIZE:
+				offset = session.resume_offset(remote_path, f, size)
+				if offset:
+					self.debug_print("Resuming '{}' at {} bytes".format(remote_path, offset))
+					f.seek(offset)
+					if session.send_file(remote_path, f, size, offset=offset) is not False:
+						return size
+					f.seek(0)
+				sums = session.block_sums(remote_path)
+				if sums:
+					sent = session.send_delta(remote_path, f, size, sums)
+					if sent is not False:
+						self.debug_print("Sent {} of {} bytes of '{}'".format(sent, size, remote_path))
+						return size
+					f.seek(0)
+			if not session.send_file(remote_path, f, size):
+				session.write_file(remote_path, f)
+		return size
+
+
+	@traced
 	def delete_button_clicked(self, button, remote_treeview, terminal_buffer):
 		""" Deletes the selected remote files/directories from the remote device.
 		"""
@@ -778,24 +3360,43 @@ class AppWindow(Gtk.ApplicationWindow):
 
 				file_in_selection = False
 				directory_in_selection = False
-				for row_selected in rows_selected:
-					fname, ftype = row_selected
-					args = None
-					if ftype == 'f':
-						args=['rm', self.current_remote_path + '/' + fname]
-						file_in_selection = True
-						self.remote_files.remove(fname)
-					elif ftype == 'd':
-						args = ['rmdir', self.current_remote_path + '/' + fname]
-						directory_in_selection = True
-						self.remote_dirs.remove(fname)
-					if args is None:
-						self.print_and_terminal(terminal_buffer, "Invalid file type detected", MsgType.ERROR)
+				if self.helper_enabled():
+					# A single session removes files and whole directory trees alike
+					deleted = 0
+					try:
+						with self.open_session() as session:
+							for fname, ftype in rows_selected:
+								self.helper_call("rm({!r})".format(self.current_remote_path + '/' + fname), session)
+								if ftype == 'f':
+									file_in_selection = True
+								else:
+									directory_in_selection = True
+								self.remote_tree_remove(remote_treeview, fname)
+								deleted += 1
+					except (PyboardError, serial.SerialException) as ex:
+						self.print_and_terminal(self.terminal_buffer, "ERROR: " + device_error_text(ex), MsgType.ERROR)
+						# What was deleted, and the row that failed, which a recursive rm may have emptied in part
+						self.remote_changed(forget=[self.current_remote_path + '/' + fname for fname, ftype in rows_selected[:deleted + 1]])
 						return
-					output=subprocess.run(self.ampy_command + args, capture_output=True)
-					if output.returncode != 0:
-						error = output.stderr.decode("UTF-8")
-						self.print_and_terminal(self.terminal_buffer, "ERROR: " + error, MsgType.ERROR)
+				else:
+					for row_selected in rows_selected:
+						fname, ftype = row_selected
+						args = None
+						if ftype == 'f':
+							args=['rm', self.current_remote_path + '/' + fname]
+							file_in_selection = True
+						elif ftype == 'd':
+							args = ['rmdir', self.current_remote_path + '/' + fname]
+							directory_in_selection = True
+						if args is None:
+							self.print_and_terminal(terminal_buffer, "Invalid file type detected", MsgType.ERROR)
+							return
+						output=self.run_ampy(args)
+						if output.returncode != 0:
+							error = output.stderr.decode("UTF-8")
+							self.print_and_terminal(self.terminal_buffer, "ERROR: " + error, MsgType.ERROR)
+						else:
+							self.remote_tree_remove(remote_treeview, fname)
 
 				# File deletion done
 				if len(rows_selected) == 1:
@@ -819,9 +3420,10 @@ class AppWindow(Gtk.ApplicationWindow):
 						self.print_and_terminal(terminal_buffer, "No files, nor directories deleted?", MsgType.ERROR)
 						return
 					msg = "{} '{}' successfully deleted from device".format(preamb, files)
-				self.fill_remote_treeview(remote_treeview)
+				self.remote_changed(forget=[self.current_remote_path + '/' + fname for fname, ftype in rows_selected])
 				self.print_and_terminal(terminal_buffer, msg, MsgType.INFO)
 
+	@traced
 	def mkdir_button_clicked(self,button, remote_treeview, terminal_buffer):
 		""" Creates a new directory on the remote device.
 		"""
@@ -835,31 +3437,205 @@ class AppWindow(Gtk.ApplicationWindow):
 				dirname = dialog.get_result()
 			dialog.destroy()
 			if dirname != '':
-				if dirname in self.remote_dirs:
+				existing = self.remote_index.get(dirname)
+				if existing is not None and existing[0] == 'd':
 					self.print_and_terminal(self.terminal_buffer, "Remote directory already exists", MsgType.WARNING)
+				if self.helper_enabled():
+					try:
+						self.helper_call("mkdir({!r})".format(self.current_remote_path + '/' + dirname))
+						self.remote_tree_add(remote_treeview, dirname, 'd')
+						self.remote_changed()
+					except (PyboardError, serial.SerialException) as ex:
+						self.print_and_terminal(self.terminal_buffer, "ERROR: " + device_error_text(ex), MsgType.ERROR)
+					return
 				args=['mkdir',self.current_remote_path+'/'+dirname]
-				output=subprocess.run(self.ampy_command+args,capture_output=True)
+				output=self.run_ampy(args)
 				if output.returncode == 0:
-					self.remote_dirs.append(dirname)
-					self.fill_remote_treeview(remote_treeview)
+					self.remote_tree_add(remote_treeview, dirname, 'd')
 				else:
 					error = output.stderr.decode("UTF-8")
 					self.print_and_terminal(self.terminal_buffer, "ERROR: " + error, MsgType.ERROR)
 
+	@traced
 	def reset_button_clicked(self,button, remote_treeview,terminal_buffer):
 		""" Performs a soft reset/reboot of the remote device.
 		"""
 		response=self.check_for_device()
 		if response == 0:
-			args=['reset']
-			output=subprocess.run(self.ampy_command+args,capture_output=True)
-			if output.returncode == 0:
+			if transport_for(self.ampy_args[0]).ampy:
+				output = self.run_ampy(['reset'])
+				error = output.stderr.decode("UTF-8") if output.returncode != 0 else None
+			else:
+				error = self.soft_reset_device()
+			self.manifest_fresh = False		# boot.py/main.py may have changed files
+			self.listing_cache.clear()
+			if error is None and self.capture is not None and self.repl_console is not None:
+				# Listing now would interrupt the booting device, whose output is being captured
+				self.set_remote_stale(True)
+				self.print_and_terminal(self.terminal_buffer, "Device reset, capturing its output. Refresh to list its files.",
+										MsgType.INFO)
+			elif error is None:
 				self.current_remote_path=""
 				self.populate_remote_tree_model(remote_treeview)
 			else:
-				error = output.stderr.decode("UTF-8")
 				self.print_and_terminal(self.terminal_buffer, "ERROR: " + error, MsgType.ERROR)
 
+	def soft_reset_device(self):
+		""" RESET over a device session, for transports ampy can't reach. Returns an error message, or None.
+		"""
+		try:
+			with self.open_session(reboot=False) as session:
+				session.soft_reset()
+		except (PyboardError, serial.SerialException) as ex:
+			return device_error_text(ex)
+		return None
+
+	def backup_dir(self, device_id):
+		return os.path.join(self.progpath, "backups", device_id or "unknown")
+
+	@traced
+	def backup_button_clicked(self, button, terminal_buffer):
+		""" Saves the whole filesystem of the remote device into backups/<device ID>/<date>-<time>.tar.
+		"""
+		response = self.check_for_device()
+		if response == 0:
+			if not self.helper_enabled():
+				self.print_and_terminal(terminal_buffer, "Backups need the device helper", MsgType.WARNING)
+				return
+			path = self.backup_device()
+			if path is not None:
+				self.print_and_terminal(terminal_buffer, "Device backed up to '{}'".format(path), MsgType.INFO)
+
+	def backup_device(self):
+		""" Streams every file of the device into a single tar archive over one device session, checking each file
+		against the sha256 computed on the device. Returns the archive path, or None on errors.
+		"""
+		writer = None
+		try:
+			with self.open_session() as session:
+				self.ensure_helper(session)
+				stamp, found = self.helper_call("find('/')", session)
+				directory = self.backup_dir(self.device_id)
+				os.makedirs(directory, exist_ok=True)
+				writer = BackupWriter(os.path.join(directory, time.strftime("%Y%m%d-%H%M%S") + ".tar"), self.device_id)
+				hashes = {}
+				for path, ftype, size in found:
+					if path == HELPER_FILE:
+						continue
+					if ftype == 'd':
+						writer.add_dir(path.lstrip("/"))
+						continue
+					self.debug_print("Backing up '{}'".format(path))
+					hashes[path] = writer.add_file(path.lstrip("/"), size, lambda: session.read_file(path, writer))
+					if self.helper_call("sha({!r})".format(path), session) != hashes[path]:
+						raise OSError("checksum mismatch for '{}'".format(path))
+			writer.close()
+		except (PyboardError, serial.SerialException, OSError) as ex:
+			if writer is not None:
+				writer.abort()
+			self.print_and_terminal(self.terminal_buffer, "Error backing up device: " + device_error_text(ex), MsgType.ERROR)
+			return None
+		manifest = self.current_manifest()
+		if manifest is not None:
+			# The walk is a complete listing of the device as well
+			manifest.set_tree(stamp, found)
+			manifest.hashes.update(hashes)
+			manifest.save()
+		return writer.path
+
+	@traced
+	def restore_button_clicked(self, button, remote_treeview, terminal_buffer):
+		""" Asks for a backup archive, by default one of the connected device, and writes it to the remote device.
+		"""
+		response = self.check_for_device()
+		if response == 0:
+			if not self.helper_enabled():
+				self.print_and_terminal(terminal_buffer, "Restoring backups needs the device helper", MsgType.WARNING)
+				return
+			if self.device_id is None:
+				try:
+					self.helper_call("uid()")
+				except (PyboardError, serial.SerialException) as ex:
+					self.print_and_terminal(terminal_buffer, "ERROR: " + device_error_text(ex), MsgType.ERROR)
+					return
+			dialog = Gtk.FileChooserDialog(title="Please choose the backup to restore", parent=self,
+										   action=Gtk.FileChooserAction.OPEN)
+			dialog.add_buttons(Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL,
+							   Gtk.STOCK_OPEN, Gtk.ResponseType.OK)
+			file_filter = Gtk.FileFilter()
+			file_filter.set_name("Device backups")
+			file_filter.add_pattern("*.tar")
+			dialog.add_filter(file_filter)
+			directory = self.backup_dir(self.device_id)
+			if os.path.isdir(directory):
+				dialog.set_current_folder(directory)
+			response = dialog.run()
+			path = dialog.get_filename()
+			dialog.destroy()
+			if response != Gtk.ResponseType.OK:
+				return
+			self.restore_backup(path, terminal_buffer)
+			self.populate_remote_tree_model(remote_treeview)
+
+	def restore_backup(self, path, terminal_buffer):
+		""" Writes every file of a backup archive to the device over one session. Files whose size and sha256 already
+		match the backup manifest are skipped, using the hashes of the device manifest while it is fresh; files that are
+		not in the backup are left alone.
+		"""
+		restored = skipped = 0
+		manifest = None
+		found = None
+		known = {}		# remote path -> sha256, from the device manifest while its stamp matches the device
+		tree = {}		# remote path -> (type, size), what the device holds
+		try:
+			with tarfile.open(path) as tar, self.open_session() as session:
+				contents = json.load(tar.extractfile(BACKUP_MANIFEST))
+				if contents["device_id"] != self.device_id:
+					self.print_and_terminal(terminal_buffer,
+											"Restoring a backup of device {}".format(contents["device_id"]),
+											MsgType.WARNING)
+				self.ensure_helper(session)
+				manifest = self.current_manifest()
+				stamp, found = self.helper_call("find('/')", session)
+				if manifest is not None and stamp == manifest.stamp:
+					known = dict(manifest.hashes)
+				tree = {entry[0]: (entry[1], entry[2]) for entry in found}
+				for name in contents["dirs"]:
+					self.helper_call("mkdir({!r})".format("/" + name), session)
+					tree["/" + name] = ('d', 0)
+				for name, (size, sha) in contents["files"].items():
+					remote_path = "/" + name
+					if tree.get(remote_path) == ('f', size):
+						if known.get(remote_path) is None:
+							known[remote_path] = self.helper_call("sha({!r})".format(remote_path), session)
+						if known[remote_path] == sha:
+							skipped += 1
+							continue
+					self.debug_print("Restoring '{}'".format(remote_path))
+					known.pop(remote_path, None)
+					f = tar.extractfile(name)
+					if not session.send_file(remote_path, f, size):
+						session.write_file(remote_path, f)
+					tree[remote_path] = ('f', size)
+					known[remote_path] = sha
+					restored += 1
+				stamp = self.helper_call("stamp()", session)
+		except (PyboardError, serial.SerialException, OSError, tarfile.TarError, ValueError, KeyError) as ex:
+			self.print_and_terminal(terminal_buffer, "Error restoring backup: " + device_error_text(ex), MsgType.ERROR)
+			stamp = None	# the file being written when it failed is unknown
+		else:
+			self.print_and_terminal(terminal_buffer,
+									"Backup restored: {} file(s) written, {} already up to date".format(restored, skipped),
+									MsgType.INFO)
+		if manifest is not None and found is not None:
+			# The walk, with what was restored on top, is a complete listing of the device
+			manifest.set_tree(stamp, [(path, ftype, size) for path, (ftype, size) in tree.items()])
+			manifest.hashes.update({path: sha for path, sha in known.items() if tree.get(path, ('d',))[0] == 'f'})
+			manifest.save()
+		self.manifest_fresh = stamp is not None
+		self.listing_cache.clear()
+
+	@traced
 	def run_local_button_clicked(self, button, local_treeview, terminal_buffer):
 		response = self.check_for_device()
 		if response == 0:
@@ -873,9 +3649,32 @@ class AppWindow(Gtk.ApplicationWindow):
 						self.run_local_file(usepath, terminal_buffer)
 
 	def run_local_file(self, local_path, terminal_buffer):
+		self.manifest_fresh = False		# the script may change files on the device
+		self.listing_cache.clear()
+		if self.profile_check.get_active():
+			with open(local_path, "rb") as f:
+				source = f.read()
+			Thread(target=self.profile_script, args=(os.path.basename(local_path), source, terminal_buffer), daemon=True).start()
+			return
+		if not transport_for(self.ampy_args[0]).ampy:
+			with open(local_path, "rb") as f:
+				source = f.read()
+			follow = self.capture is None or self.repl_console is None
+			Thread(target=self.run_script, args=(os.path.basename(local_path), source, terminal_buffer, follow),
+				   daemon=True).start()
+			return
+		if self.capture is not None and self.repl_console is not None:
+			# Don't wait for the script, its output goes to the capture log
+			output = self.run_ampy(['run', '--no-output', local_path], os.path.getsize(local_path))
+			if output.returncode == 0:
+				self.print_and_terminal(terminal_buffer, "Started local file {}, its output is captured".format(
+					os.path.basename(local_path)), MsgType.INFO)
+			else:
+				self.print_and_terminal(terminal_buffer, output.stderr.decode("UTF-8"), MsgType.ERROR)
+			return
 		args = ['run', local_path]
 		try:
-			output = subprocess.run(self.ampy_command + args, capture_output=True)
+			output = self.run_ampy(args, os.path.getsize(local_path))
 			if output.returncode == 0:
 				self.print_and_terminal(terminal_buffer, "---------Running local file {}---------".format(os.path.basename(local_path)),
 										MsgType.INFO)
@@ -887,6 +3686,312 @@ class AppWindow(Gtk.ApplicationWindow):
 		except PyboardError as e:
 			self.print_and_terminal(terminal_buffer, e, MsgType.ERROR)
 
+	def run_script(self, name, source, terminal_buffer, follow=True):
+		""" Runs in the background: RUN over a device session, for transports ampy can't reach. With follow, the output
+		streams to the terminal until the script ends, without a deadline like 'ampy run', or until a device operation
+		waits for the port. Without, the script is only started, like 'ampy run --no-output' does.
+		"""
+		pending = bytearray()
+		def show(data):
+			pending.extend(data)
+			end = pending.rfind(b'\n')
+			if end >= 0:
+				self.set_terminal_text(terminal_buffer, pending[:end + 1].decode("UTF-8", "replace").replace("\r", ""), MsgType.INFO)
+				del pending[:end + 1]
+		try:
+			with self.open_session() as session:
+				if not follow:
+					session.send(source)
+					self.print_and_terminal(terminal_buffer, "Started local file {}, its output is captured".format(name),
+											MsgType.INFO)
+					return
+				self.print_and_terminal(terminal_buffer, "---------Running local file {}---------".format(name), MsgType.INFO)
+				session.cancel = self.device_lock.contended
+				try:
+					session.exec(source, timeout=float("inf"), consumer=show)
+				finally:
+					if pending:
+						self.set_terminal_text(terminal_buffer, pending.decode("UTF-8", "replace") + "\n", MsgType.INFO)
+				self.print_and_terminal(terminal_buffer, "----------------------------", MsgType.INFO)
+		except DeviceCancelled:
+			self.print_and_terminal(terminal_buffer, "---------{} stopped---------".format(name), MsgType.INFO)
+		except (PyboardError, serial.SerialException) as ex:
+			traceback = len(ex.args) == 3 and isinstance(ex.args[2], bytes)
+			self.print_and_terminal(terminal_buffer, ex.args[2].decode("UTF-8", "replace").strip() if traceback
+									else device_error_text(ex), MsgType.ERROR)
+
+	@traced
+	def watch_button_toggled(self, button, local_treeview, terminal_buffer):
+		""" Starts or stops watch mode for current_local_path. The entry script is the selected local file, or
+		watch_entry.
+		"""
+		if not button.get_active():
+			if self.watch_state is not None:
+				self.watch_state = None
+				self.watch_generation += 1		# stops the entry script
+				self.print_and_terminal(terminal_buffer, "Stopped watching", MsgType.INFO)
+			return
+		if not self.helper_enabled():
+			self.print_and_terminal(terminal_buffer, "Watch mode needs the device helper", MsgType.ERROR)
+			button.set_active(False)
+			return
+		entry = self.watch_entry
+		rows_selected = self.local_rows_selected(local_treeview) or []
+		if len(rows_selected) == 1 and os.path.isfile(os.path.join(self.current_local_path, rows_selected[0])):
+			entry = rows_selected[0]
+		self.watch_state = (self.current_local_path, self.current_remote_path, entry)
+		# What is there now is taken to be on the device already, only changes from here on are deployed
+		self.watch_seen = self.watch_snapshot()
+		self.watch_deployed = self.watch_hashes()
+		self.watch_changed_at = 0
+		self.print_and_terminal(terminal_buffer, "Watching '{}', changes go to '{}/' and run '{}'".format(
+			self.current_local_path, self.current_remote_path, entry), MsgType.INFO)
+		GLib.timeout_add(300, self.watch_tick, self.watch_state)
+
+	def watch_snapshot(self):
+		return {rel: (st.st_size, st.st_mtime_ns) for rel, st in self.local_index(self.watch_state[0]).walk()}
+
+	def watch_hashes(self):
+		""" sha256 of every watched file, from the local index, which only hashes the files that changed since its last
+		scan.
+		"""
+		return {rel: entry[2] for rel, entry in self.local_index(self.watch_state[0]).scan().items()}
+
+	def watch_tick(self, state):
+		""" Polls the watched directory. A deploy starts once the files stopped changing for one poll, so an editor
+		saving several files, or one file in several writes, causes a single deploy. Only files whose contents differ
+		from what was deployed are uploaded, so files that were merely touched, e.g. by a git checkout, cause none.
+		"""
+		if state is not self.watch_state:
+			return False
+		snapshot = self.watch_snapshot()
+		if snapshot != self.watch_seen:
+			self.watch_seen = snapshot
+			self.watch_changed_at = time.monotonic()
+			return True
+		if not self.watch_changed_at:
+			return True
+		self.watch_changed_at = 0
+		hashes = self.watch_hashes()
+		changed = sorted(rel for rel, digest in hashes.items() if self.watch_deployed.get(rel) != digest)
+		if not changed:
+			return True
+		dirs = {os.path.dirname(rel) for rel in self.watch_deployed}
+		new_dirs = sorted({os.path.dirname(rel) for rel in changed} - dirs - {""})
+		self.watch_deployed = hashes
+		self.watch_generation += 1
+		Thread(target=self.watch_deploy, args=(state, changed, new_dirs, self.watch_generation), daemon=True).start()
+		return True
+
+	def watch_deploy(self, state, changed, new_dirs, generation):
+		""" Runs in the background: uploads the changed files over one session, resets the device as configured by
+		watch_reset and runs the entry script, streaming its output to the terminal until it ends or the next deploy
+		(or any other device operation) interrupts it.
+		"""
+		local_root, remote_root, entry = state
+		terminal_buffer = self.terminal_buffer
+		uploaded = []
+		start = time.monotonic()
+		try:
+			# Soft reset only when configured, and then after the upload
+			with self.open_session(reboot=False) as session:
+				self.ensure_helper(session)
+				for rel in new_dirs:
+					self.helper_call("mkdir({!r})".format(remote_root + "/" + rel), session)
+				for rel in changed:
+					uploaded.append((rel, self.upload_file(session, os.path.join(local_root, rel), remote_root + "/" + rel)))
+				GLib.idle_add(self.watch_uploaded, remote_root, uploaded, new_dirs)
+				if changed:
+					self.print_and_terminal(terminal_buffer, "Deployed {} in {:.1f}s".format(
+						", ".join(changed), time.monotonic() - start), MsgType.INFO)
+				if self.watch_reset == "soft":
+					session.soft_reset()
+				elif self.watch_reset == "reimport":
+					paths = ["/" + (remote_root + "/" + rel).strip("/") for rel in changed if rel.endswith(".py")]
+					session.exec(WATCH_REIMPORT.format(paths))
+				if not os.path.isfile(os.path.join(local_root, entry)):
+					return
+				self.print_and_terminal(terminal_buffer, "---------Running {}---------".format(entry), MsgType.INFO)
+				pending = bytearray()
+				def show(data):
+					pending.extend(data)
+					end = pending.rfind(b'\n')
+					if end >= 0:
+						self.set_terminal_text(terminal_buffer, pending[:end + 1].decode("UTF-8", "replace").replace("\r", ""), MsgType.INFO)
+						del pending[:end + 1]
+				session.cancel = lambda: generation != self.watch_generation or self.device_lock.contended()
+				try:
+					session.exec("exec(open({!r}).read(),{{'__name__':'__main__'}})".format(remote_root + "/" + entry),
+								 timeout=self.watch_timeout or float("inf"), consumer=show)
+				finally:
+					session.cancel = None
+					if pending:
+						self.set_terminal_text(terminal_buffer, pending.decode("UTF-8", "replace") + "\n", MsgType.INFO)
+				self.print_and_terminal(terminal_buffer, "----------------------------", MsgType.INFO)
+		except DeviceCancelled:
+			self.print_and_terminal(terminal_buffer, "---------{} stopped---------".format(entry), MsgType.INFO)
+		except (PyboardError, serial.SerialException, OSError) as ex:
+			self.print_and_terminal(terminal_buffer, "Watch deploy failed: " + device_error_text(ex), MsgType.ERROR)
+			if len(uploaded) < len(changed):
+				GLib.idle_add(self.watch_retry, state, changed[len(uploaded):])
+
+	def watch_uploaded(self, remote_root, uploaded, new_dirs):
+		""" Shows the files uploaded by watch_deploy() in the remote view and manifest.
+		"""
+		if remote_root != self.current_remote_path:
+			self.manifest_fresh = False
+			self.listing_cache.clear()
+			return False
+		forget = set()
+		for rel, size in uploaded:
+			if "/" in rel:
+				self.remote_tree_add(self.remote_treeview, rel.split("/")[0], 'd')
+				forget.add(remote_root + "/" + os.path.dirname(rel))
+			else:
+				self.remote_tree_add(self.remote_treeview, rel, 'f', size)
+		forget.update(remote_root + "/" + rel for rel in new_dirs)
+		self.remote_changed(forget=sorted(forget))
+		return False
+
+	def watch_retry(self, state, failed):
+		""" Marks files that did not make it to the device, so the next poll deploys them again.
+		"""
+		if state is self.watch_state:
+			for rel in failed:
+				self.watch_deployed.pop(rel, None)
+			self.watch_changed_at = time.monotonic()
+		return False
+
+	@traced
+	def bench_button_clicked(self, button, local_treeview, terminal_buffer):
+		response = self.check_for_device()
+		if response == 0:
+			paths = [os.path.join(self.current_local_path, row) for row in self.local_rows_selected(local_treeview) or []]
+			paths = [path for path in paths if os.path.isfile(path)]
+			if paths:
+				Thread(target=self.bench_files, args=(paths, terminal_buffer), daemon=True).start()
+
+	def bench_dir(self, device_id):
+		return os.path.join(self.progpath, "benchmarks", (device_id or os.path.basename(self.ampy_args[0].rstrip("/"))
+														  or "device").replace(":", "_"))
+
+	def bench_files(self, paths, terminal_buffer):
+		""" Runs in the background: times the bench_* functions of each file on the device with BENCH_HARNESS, shows
+		min/median/p95 next to the change of the median against the baseline, and saves the results per device, file
+		and git commit in benchmarks/. The baseline is the bench_baseline commit if configured, else the latest
+		results of another commit.
+		"""
+		warmup = self.config['DEFAULT'].getint('bench_warmup', 3)
+		repeat = self.config['DEFAULT'].getint('bench_repeat', 20)
+		for path in paths:
+			name = os.path.basename(path)
+			with open(path, "rb") as f:
+				source = f.read()
+			try:
+				functions = bench_functions(source)
+			except SyntaxError as ex:
+				self.print_and_terminal(terminal_buffer, "Can't read {}: {}".format(name, ex), MsgType.ERROR)
+				continue
+			if not functions:
+				self.print_and_terminal(terminal_buffer, "{} has no bench_* functions".format(name), MsgType.WARNING)
+				continue
+			results = {}
+			device_id = self.device_id
+			try:
+				with self.open_session() as session:
+					if self.helper_enabled():
+						device_id = self.ensure_helper(session)
+					# A device operation started meanwhile would block the main loop until the benchmark is done
+					session.cancel = self.device_lock.contended
+					session.exec(BENCH_HARNESS)
+					self.show_bench_output(terminal_buffer, session.exec(source))
+					for function in functions:
+						output, times = bench_reply(session.exec("_bench({},{},{})".format(function, warmup, repeat),
+																 timeout=self.deadline * (warmup + repeat)))
+						self.show_bench_output(terminal_buffer, output)
+						results[function] = bench_stats(times)
+			except DeviceCancelled:
+				self.print_and_terminal(terminal_buffer, "Benchmark {} stopped, the device was needed".format(name),
+										MsgType.WARNING)
+				return
+			except (PyboardError, serial.SerialException) as ex:
+				self.print_and_terminal(terminal_buffer, "Benchmark {} failed: {}".format(name, device_error_text(ex)),
+										MsgType.ERROR)
+				continue
+
+			commit = source_commit(path) or "uncommitted"
+			directory = os.path.join(self.bench_dir(device_id), os.path.splitext(name)[0])
+			baseline = self.bench_baseline(directory, commit)
+			self.print_and_terminal(terminal_buffer, "{} on {} at {} ({} warmup, {} runs){}".format(
+				name, device_id or self.ampy_args[0], commit, warmup, repeat,
+				", compared to " + baseline["commit"] if baseline else ""), MsgType.INFO)
+			for function, stats in results.items():
+				change = ""
+				before = baseline and baseline["results"].get(function)
+				if before and before["median"]:
+					change = "{:+7.1f}%".format((stats["median"] - before["median"]) * 100 / before["median"])
+				self.print_and_terminal(terminal_buffer, "  {:<24} min {:>9.1f} us  median {:>9.1f} us  p95 {:>9.1f} us  {}".format(
+					function, stats["min"], stats["median"], stats["p95"], change), MsgType.INFO)
+			os.makedirs(directory, exist_ok=True)
+			with open(os.path.join(directory, commit + ".json"), "w") as f:
+				json.dump({"commit": commit, "time": time.time(), "warmup": warmup, "repeat": repeat, "results": results}, f)
+
+	def show_bench_output(self, terminal_buffer, output):
+		""" Shows what the benchmarked file printed, if anything.
+		"""
+		text = output.decode("UTF-8", "replace").replace("\r", "").strip()
+		if text:
+			self.print_and_terminal(terminal_buffer, text, MsgType.INFO)
+
+	def bench_baseline(self, directory, commit):
+		""" The stored results to compare the results of commit with, or None.
+		"""
+		baseline = self.config['DEFAULT'].get('bench_baseline', '')
+		runs = []
+		for path in glob.glob(os.path.join(directory, "*.json")):
+			try:
+				with open(path) as f:
+					runs.append(json.load(f))
+			except (OSError, ValueError):
+				continue
+		if baseline:
+			runs = [run for run in runs if run["commit"] == baseline]
+		else:
+			runs = [run for run in runs if run["commit"] != commit]
+		return max(runs, key=lambda run: run["time"], default=None)
+
+	def profile_script(self, name, source, terminal_buffer):
+		""" Runs in the background: runs source with the heap sampled every profile_interval ms, streams its output to
+		the terminal, then shows a summary and saves the samples in profiles/.
+		"""
+		interval = self.config['DEFAULT'].getint('profile_interval', 100)
+		stream = ProfileStream(lambda text: self.set_terminal_text(terminal_buffer, text, MsgType.INFO))
+		error = None
+		self.print_and_terminal(terminal_buffer, "---------Profiling {}---------".format(name), MsgType.INFO)
+		try:
+			with self.open_session() as session:
+				session.write_file(PROFILE_FILE, io.BytesIO(source))
+				# No deadline, like any other RUN, but the port is given up as soon as a device operation waits for it
+				session.cancel = self.device_lock.contended
+				session.exec(PROFILE_RUN.format(interval, repr(PROFILE_FILE), repr(name)), timeout=float("inf"),
+							 consumer=stream.feed)
+		except (PyboardError, serial.SerialException) as ex:
+			error = ex		# if the script raised, the profile is still taken
+		stream.close()
+		if error is not None:
+			traceback = len(error.args) == 3 and isinstance(error.args[2], bytes)
+			self.print_and_terminal(terminal_buffer, error.args[2].decode("UTF-8", "replace").strip() if traceback
+									else device_error_text(error), MsgType.ERROR)
+		for line in stream.summary():
+			self.print_and_terminal(terminal_buffer, line, MsgType.INFO)
+		if stream.samples:
+			path = os.path.join(self.progpath, "profiles", "{}-{}.csv".format(
+				os.path.splitext(name)[0], datetime.datetime.now().strftime("%Y%m%d-%H%M%S")))
+			stream.write_csv(path)
+			self.print_and_terminal(terminal_buffer, "Samples saved to '{}'".format(path), MsgType.INFO)
+		self.print_and_terminal(terminal_buffer, "----------------------------", MsgType.INFO)
+
+	@traced
 	def run_remote_button_clicked(self,button, remote_treeview, terminal_buffer):
 		response=self.check_for_device()
 		if response == 0:
@@ -903,11 +4008,13 @@ class AppWindow(Gtk.ApplicationWindow):
 						usepath = self.current_remote_path +'/' + fname
 
 						# Fetch the file to be run from the remote device as a temp file, run that local temp file, then delete the temp file
-						tmp_file = os.path.join(self.progpath, "tmp", fname)
-						self.get_file(terminal_buffer, usepath, tmp_file, print=False)
+						tmp_file = os.path.join(self.progpath, "tmp", os.path.basename(fname))
+						self.get_file(None, terminal_buffer, usepath, tmp_file, print=False,
+									  size=(self.remote_index.get(fname) or (ftype, 0))[1])
 						self.run_local_file(tmp_file, terminal_buffer)
 						os.remove(tmp_file)
 
+	@traced
 	def on_local_row_selected(self, tree_selection):
 		model, paths = tree_selection.get_selected_rows()
 		if self.connected and paths and len(paths) > 0:
@@ -924,10 +4031,13 @@ class AppWindow(Gtk.ApplicationWindow):
 					all_files = False
 					break
 			self.run_local_button.set_sensitive(all_files)
+			self.bench_button.set_sensitive(all_files)
 		else:
 			self.put_button.set_sensitive(False)
 			self.run_local_button.set_sensitive(False)
+			self.bench_button.set_sensitive(False)
 
+	@traced
 	def on_local_row_activated(self, local_treeview, fpath, column):
 		model = local_treeview.get_model()
 		iterator = model.get_iter(fpath)
@@ -946,24 +4056,43 @@ class AppWindow(Gtk.ApplicationWindow):
 		if value:
 			# The other buttons need a file or directory to be selected first
 			self.remote_refresh_button.set_sensitive(True)
+			self.remote_search_entry.set_sensitive(True)
+			self.probe_button.set_sensitive(True)
 			self.mkdir_button.set_sensitive(True)
 			self.reset_button.set_sensitive(True)
 			self.run_remote_button.set_sensitive(True)
+			self.backup_button.set_sensitive(True)
+			self.restore_button.set_sensitive(True)
+			self.watch_button.set_sensitive(True)
 		else:
 			self.remote_refresh_button.set_sensitive(False)
+			self.remote_search_entry.set_sensitive(False)
+			self.probe_button.set_sensitive(False)
 			self.get_button.set_sensitive(False)
 			self.mkdir_button.set_sensitive(False)
 			self.delete_button.set_sensitive(False)
 			self.reset_button.set_sensitive(False)
 			self.run_remote_button.set_sensitive(False)
+			self.backup_button.set_sensitive(False)
+			self.restore_button.set_sensitive(False)
+			self.watch_button.set_active(False)
+			self.watch_button.set_sensitive(False)
+			self.stop_console()
+
 	def enable_remote_file_buttons(self, value: bool):
 		self.get_button.set_sensitive(value)
 		self.run_remote_button.set_sensitive(value)
 		self.delete_button.set_sensitive(value)
 
+	@traced
 	def on_remote_row_selected(self, tree_selection):
-		response = self.check_for_device()
-		if response == 0:
+		if self.remote_search_active:
+			# Search hits can only be activated, to jump to their directory
+			self.enable_remote_file_buttons(False)
+			return
+		# Selection changes come in bursts: use the connection state as it is and only check the device afterwards
+		self.schedule_device_check()
+		if self.connected:
 			model, paths = tree_selection.get_selected_rows()
 			only_files_selected = True
 			for fpath in paths:
@@ -979,26 +4108,153 @@ class AppWindow(Gtk.ApplicationWindow):
 		else:
 			self.enable_remote_file_buttons(False)
 
+	@traced
 	def on_remote_row_activated(self, remote_treeview, fpath, column):
 		response=self.check_for_device()
 		if response == 0:
 			model = remote_treeview.get_model()
 			iterator = model.get_iter(fpath)
 			if iterator:
-				fname = model.get_value(iterator, self.FILENAME)
+				fname = model.get_value(iterator, self.PATH)
 				ftype = model.get_value(iterator, self.TYPE)
-				
+
+				if self.remote_search_active:
+					self.jump_to_remote_path(remote_treeview, fname)
+					return
 
 				location = self.current_remote_path  + '/' + fname
 				
 				if fname == "..":
 					head,tail = os.path.split(self.current_remote_path)
 					self.current_remote_path = head
-					self.populate_remote_tree_model(remote_treeview)
+					self.populate_remote_tree_model(remote_treeview, cached=True)
 				else:
 					if ftype == 'd':
 						self.current_remote_path = location
-						self.populate_remote_tree_model(remote_treeview)
+						self.populate_remote_tree_model(remote_treeview, cached=True)
+
+	@traced
+	def on_terminal_page_switched(self, notebook, page, page_num):
+		self.repl_visible = page_num == 1
+		self.update_console()
+		if self.repl_visible:
+			self.repl_view.grab_focus()
+
+	@traced
+	def on_capture_toggled(self, button):
+		if button.get_active():
+			name = self.device_id or os.path.basename(self.ampy_args[0].rstrip("/")) or "device"
+			path = os.path.join(self.progpath, "logs", name.replace(":", "_"), "capture.log")
+			self.capture = CaptureLog(path, self.config['DEFAULT'].getint('capture_max_bytes', 1 << 20),
+									  self.config['DEFAULT'].getint('capture_keep', 5))
+			self.print_and_terminal(self.terminal_buffer, "Capturing device output to '{}'".format(path), MsgType.INFO)
+			GLib.timeout_add(500, self.show_capture_tail, self.capture, 0)
+		elif self.capture is not None:
+			self.capture.close()
+			self.print_and_terminal(self.terminal_buffer, "Stopped capturing, {} line(s) logged".format(self.capture.lines),
+									MsgType.INFO)
+			self.capture = None
+		self.update_console()
+
+	def show_capture_tail(self, capture, shown):
+		""" Shows the last captured line twice a second, whatever the rate the device prints at.
+		"""
+		if capture is not self.capture:
+			return False
+		lines = capture.lines
+		if lines != shown:
+			skipped = " (+{} lines)".format(lines - shown - 1) if lines - shown > 1 else ""
+			self.print_and_terminal(self.terminal_buffer, "[device] {}{}".format(capture.tail, skipped), MsgType.INFO)
+			GLib.timeout_add(500, self.show_capture_tail, capture, lines)
+			return False
+		return True
+
+	def update_console(self):
+		""" Runs the device console while it is needed: for the REPL tab, or to capture the device output.
+		"""
+		if self.connected and (self.repl_visible or self.capture is not None):
+			self.start_console()
+		else:
+			self.stop_console()
+
+	def start_console(self):
+		""" Hands the port to the device console. It keeps it until it is no longer needed, and gives it up for the
+		duration of every other device operation (see DeviceLock).
+		"""
+		if self.repl_console is not None:
+			return
+		self.repl_console = ReplConsole(self.ampy_args[0], self.ampy_args[1], self.device_output, self.console_closed)
+		with self.device_lock:
+			self.device_lock.console = self.repl_console
+		# The console is running now that the lock is free, get a fresh prompt
+		self.repl_console.write(b'\r')
+
+	def stop_console(self):
+		if self.repl_console is None:
+			return
+		with self.device_lock:
+			self.device_lock.console = None
+			self.repl_console.close()
+		self.repl_console = None
+
+	def device_output(self, data):
+		""" Runs in the console's reader thread, or in a session's on the console's port: logs the output when capturing,
+		and shows it in the REPL tab.
+		"""
+		capture = self.capture
+		if capture is not None:
+			capture.write(data)
+		if self.repl_visible:
+			GLib.idle_add(self.show_repl_output, data)
+
+	def console_closed(self, error):
+		""" Runs in any thread, when the console lost its port.
+		"""
+		GLib.idle_add(self.show_repl_output, "\r\n[port closed: {}]\r\n".format(error).encode("UTF-8"))
+		GLib.idle_add(self.stop_console)
+
+	def show_repl_output(self, data):
+		""" Replaces the line being edited with its new state, after appending the lines data completed.
+		"""
+		buffer = self.repl_buffer
+		buffer.delete(buffer.get_iter_at_mark(self.repl_line), buffer.get_end_iter())
+		for line in self.repl_screen.feed(data):
+			buffer.insert(buffer.get_end_iter(), line + "\n")
+		buffer.move_mark(self.repl_line, buffer.get_end_iter())
+		buffer.insert(buffer.get_end_iter(), self.repl_screen.text())
+		# Keep the scrollback bounded
+		if buffer.get_line_count() > 5000:
+			buffer.delete(buffer.get_start_iter(), buffer.get_iter_at_line(buffer.get_line_count() - 5000))
+		cursor = buffer.get_iter_at_mark(self.repl_line)
+		cursor.forward_chars(self.repl_screen.col)
+		buffer.place_cursor(cursor)
+		self.repl_view.scroll_mark_onscreen(buffer.get_insert())
+		return False
+
+	def on_repl_key_press(self, view, event):
+		""" Sends keystrokes straight to the device. Ctrl+<letter> sends the control character (Ctrl-C interrupts,
+		Ctrl-D soft resets, Ctrl-E pastes), Ctrl+Shift+V pastes the clipboard.
+		"""
+		if self.repl_console is None:
+			return False
+		name = Gdk.keyval_name(event.keyval) or ""
+		control = event.state & Gdk.ModifierType.CONTROL_MASK
+		if control and event.state & Gdk.ModifierType.SHIFT_MASK and name in ("V", "v"):
+			text = Gtk.Clipboard.get(Gdk.SELECTION_CLIPBOARD).wait_for_text()
+			if text:
+				self.repl_console.write(text.replace("\r\n", "\r").replace("\n", "\r").encode("UTF-8"))
+			return True
+		if control and len(name) == 1 and name.isalpha():
+			self.repl_console.write(bytes([ord(name.lower()) - ord('a') + 1]))
+			return True
+		if name in REPL_KEYS:
+			self.repl_console.write(REPL_KEYS[name])
+			return True
+		char = Gdk.keyval_to_unicode(event.keyval)
+		if char:
+			self.repl_console.write(chr(char).encode("UTF-8"))
+			return True
+		return False
 
 	def clear_terminal(self, button, textbuffer):
 		textbuffer.delete(textbuffer.get_start_iter(), textbuffer.get_end_iter())
@@ -1006,6 +4262,9 @@ class AppWindow(Gtk.ApplicationWindow):
 	def set_terminal_text(self,textbuffer, inString,  msgType: MsgType):
 		if textbuffer is None:
 			return
+		if current_thread() is not main_thread():
+			GLib.idle_add(self.set_terminal_text, textbuffer, inString, msgType)
+			return
 		end_iterator = textbuffer.get_end_iter()
 		textbuffer.insert_markup(end_iterator, "<span color='{}'>>>> {}</span>".format(msgType.value, inString), -1)
 
@@ -1017,14 +4276,90 @@ class AppWindow(Gtk.ApplicationWindow):
 		self.debug_print(inString)
 		self.set_terminal_text(textbuffer, inString + "\n", msgType)
 
+	@traced
 	def on_refresh_local_button_clicked(self, button, local_treeview):
 		self.populate_local_tree_model(local_treeview)
 
+	@traced
 	def on_refresh_remote_button_clicked(self, button, remote_treeview):
 		response=self.check_for_device()
 		if response == 0:
+			self.end_remote_search()
 			self.populate_remote_tree_model(remote_treeview)
 
+	@traced
+	def on_remote_search_changed(self, search_entry):
+		""" Filters the cached index of the whole device, only the first search after the device changed needs a
+		device round trip.
+		"""
+		pattern = search_entry.get_text().strip()
+		if pattern == "":
+			if self.remote_search_active:
+				self.end_remote_search()
+				self.fill_remote_treeview(self.remote_treeview)
+			return
+		if self.remote_search_cache is None:
+			self.remote_search_cache = self.load_remote_search_index()
+			if self.remote_search_cache is None:
+				return
+		self.remote_search_active = True
+		self.fill_remote_search_results(self.remote_treeview, match_remote_paths(self.remote_search_cache, pattern))
+
+	def load_remote_search_index(self):
+		""" Returns [(lowercase path, path, type), ...] of every entry on the device, from the manifest if it covers
+		the whole device and is known to be current, otherwise from a single full walk on the device.
+		"""
+		if not self.helper_enabled():
+			self.print_and_terminal(self.terminal_buffer, "Searching the device needs the device helper", MsgType.WARNING)
+			return None
+		manifest = self.current_manifest()
+		if manifest is not None and manifest.complete and self.manifest_fresh:
+			paths = manifest.paths()
+		else:
+			self.print_and_terminal(self.terminal_buffer, "Indexing remote device...", MsgType.INFO)
+			try:
+				stamp, paths = self.helper_call("find()")
+			except (PyboardError, serial.SerialException) as ex:
+				self.print_and_terminal(self.terminal_buffer, "ERROR: " + device_error_text(ex), MsgType.ERROR)
+				return None
+			# The device ID may only be known now
+			manifest = self.current_manifest()
+			if manifest is not None:
+				manifest.set_tree(stamp, paths)
+				manifest.save()
+				self.manifest_fresh = True
+		return sorted((path.lower(), path, ftype) for path, ftype, size in paths)
+
+	def fill_remote_search_results(self, remote_treeview, hits):
+		remote_store = remote_treeview.get_model()
+		remote_treeview.set_model(None)
+		remote_store.clear()
+		for path, ftype in hits:
+			remote_store.insert(None, -1, [self.pixbuf(ftype), path, ftype, path])
+		remote_treeview.set_model(remote_store)
+		remote_treeview.columns_autosize()
+		self.enable_remote_file_buttons(False)
+
+	def end_remote_search(self):
+		self.remote_search_active = False
+		self.remote_search_cache = None
+		if self.remote_search_entry.get_text() != "":
+			self.remote_search_entry.set_text("")
+
+	def jump_to_remote_path(self, remote_treeview, path):
+		""" Leaves the search results and shows the directory containing path, with path selected.
+		"""
+		parent, name = path.rsplit('/', 1)
+		self.end_remote_search()
+		self.current_remote_path = parent
+		self.populate_remote_tree_model(remote_treeview, cached=True)
+		if name in self.remote_index:
+			tree_path = Gtk.TreePath(self.remote_index.position(name) + 1)	# row 0 is '..'
+			remote_treeview.get_selection().unselect_all()
+			remote_treeview.get_selection().select_path(tree_path)
+			remote_treeview.scroll_to_cell(tree_path, None, False, 0, 0)
+
+	@traced
 	def on_local_dir_chooser_button_clicked(self, button, local_treeview):
 		dialog = Gtk.FileChooserDialog(title="Please choose the local parent directory", parent=self,
 									   action=Gtk.FileChooserAction.SELECT_FOLDER)
@@ -1070,27 +4405,79 @@ class PopUp(Gtk.Dialog):
 	def get_result(self):
 		return self.result
 
+def read_until(stream, ending, deadline):
+	""" Reads from stream until ending or deadline (a time.monotonic() value), returns what was read.
+	"""
+	data = b''
+	while not data.endswith(ending) and time.monotonic() < deadline:
+		data += stream.read(stream.in_waiting or 1)
+	return data
+
+def probe_board(port, baud, timeout):
+	""" Identifies the MicroPython board on port within about timeout seconds: interrupts whatever runs, asks the raw
+	REPL for BOARD_PROBE and reads the banner the REPL prints when it is left. Returns (board, firmware, unique ID),
+	raises PyboardError if nothing like a MicroPython REPL answers.
+	"""
+	deadline = time.monotonic() + timeout
+	board = firmware = uid = None
+	stream = transport_for(port).open(port, baud)
+	try:
+		stream.timeout = 0.05
+		stream.write(b'\r\x03\x03')
+		time.sleep(0.05)
+		stream.reset_input_buffer()
+		stream.write(b'\x01')
+		if read_until(stream, b'raw REPL; CTRL-B to exit\r\n>', deadline).endswith(b'>'):
+			stream.write(BOARD_PROBE.encode("UTF-8") + b'\x04')
+			reply = read_until(stream, b'\x04>', deadline)
+			if reply.startswith(b'OK') and reply.endswith(b'\x04>'):
+				out, err = reply[2:-2].split(b'\x04', 1)
+				try:
+					board, name, version, uid = ast.literal_eval(out.decode("UTF-8").strip())
+					firmware = "{} {}".format(name, version)
+				except (ValueError, SyntaxError, UnicodeDecodeError):
+					pass
+		stream.write(b'\x02')
+		banner = BANNER.search(read_until(stream, b'>>> ', deadline).decode("UTF-8", "replace"))
+		if banner:
+			board = banner.group(4)
+			firmware = "{} {} ({})".format(*banner.group(1, 2, 3))
+	finally:
+		stream.close()
+	if board is None and firmware is None:
+		raise PyboardError("no MicroPython REPL")
+	return board, firmware, uid
+
 class SelectPortPopUp(Gtk.Dialog):
+	PORT, BOARD, FIRMWARE, ID = range(4)	# columns of the port list
+
+	probed = {}		# port -> (hardware ID of the port when probed, (board, firmware, unique ID) or (None, error, None))
+	probing = set()	# ports with a probe running
+
 	def __init__(self, parent):
 		Gtk.Dialog.__init__(self, "Select port", parent, 0)
 		self.add_buttons(Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL,
 						 Gtk.STOCK_OK, Gtk.ResponseType.OK)
 
 		self.connect("response", self.on_response)
-		self.set_default_size(500, 400)
+		self.connect("destroy", self.on_destroy)
+		self.set_default_size(700, 400)
 		self.set_border_width(10)
 
+		self.app_window = parent
+		self.ports = OrderedDict()	# port -> hardware ID, as last listed
+		self.detect = False			# whether ports showing up are probed right away
+
 		# Init the treeview
 		self.treeview = Gtk.TreeView.new()
-		liststore = Gtk.ListStore(str)
+		liststore = Gtk.ListStore(str, str, str, str)
 		self.treeview.set_model(liststore)
-		column = Gtk.TreeViewColumn.new()
-		column.set_title("Available serial ports")
-
-		renderer = Gtk.CellRendererText.new()
-		column.pack_start(renderer, True)
-		column.add_attribute(renderer, "text", 0)
-		self.treeview.append_column(column)
+		for title, col in (("Available serial ports", self.PORT), ("Board", self.BOARD), ("Firmware", self.FIRMWARE),
+						   ("ID", self.ID)):
+			renderer = Gtk.CellRendererText.new()
+			column = Gtk.TreeViewColumn(title, renderer, text=col)
+			column.set_resizable(True)
+			self.treeview.append_column(column)
 		self.treeview.connect("row-activated", self.on_row_activated)
 
 		# Fill the treeview
@@ -1101,36 +4488,130 @@ class SelectPortPopUp(Gtk.Dialog):
 		refresh_button.set_tooltip_text("Refresh the list of available ports")
 		refresh_button.connect("clicked", self.refresh_ports, self.treeview)
 
+		# Button for probing the ports
+		detect_button = Gtk.Button.new_with_label("Auto-detect")
+		detect_button.set_tooltip_text("Look for a MicroPython board on every port. This interrupts whatever runs on the boards.")
+		detect_button.connect("clicked", self.detect_ports)
+
+		button_box = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL)
+		button_box.pack_start(refresh_button, True, True, 0)
+		button_box.pack_start(detect_button, True, True, 4)
+
 		# Info label
-		info_label = Gtk.Label.new("Tip: don't know which port your remote device uses?\n\tUnplug your remote device, click the 'Refresh' button, plug it in again, and click the 'Refresh' button again.\n\tYour device port should now be displayed in the list..")
+		info_label = Gtk.Label.new("Tip: don't know which port your remote device uses?\n\tClick 'Auto-detect' to find the MicroPython boards.\n\tOr unplug your remote device, click the 'Refresh' button, plug it in again, and click the 'Refresh' button again.\n\tYour device port should now be displayed in the list..")
 
 		# Add the widgets to the dialog
 		area = self.get_content_area()
 		area.pack_start(self.treeview, True, True, 4)
-		area.pack_start(refresh_button, False, False, 4)
+		area.pack_start(button_box, False, False, 4)
 		area.pack_start(info_label, False, False, 4)
 
+		# Ports come and go while the dialog is open
+		self.hotplug_source = GLib.timeout_add(1000, self.check_hotplug)
+
 		self.show_all()
 
 	def refresh_ports(self, button, treeview):
 		# Get all the ports
-		ports = self.get_ports()
+		self.ports = self.get_ports()
+		self.forget_unplugged()
 
-		remote_store = treeview.get_model()
+		remote_store, selected = treeview.get_selection().get_selected()
+		selected = remote_store.get_value(selected, self.PORT) if selected else None
 		remote_store.clear()
 
-		for port in ports:
+		for port in self.ports:
 			iterator = remote_store.append()
-			remote_store.set(iterator, 0, port)
+			remote_store.set(iterator, self.PORT, port)
+			self.show_probe(port)
+			if port == selected:
+				treeview.get_selection().select_iter(iterator)
+
+	def forget_unplugged(self):
+		""" Drops the probe results of ports that are gone or now belong to another adapter.
+		"""
+		for port, (hwid, info) in list(self.probed.items()):
+			if self.ports.get(port, False) != hwid:
+				del self.probed[port]
+
+	def check_hotplug(self):
+		ports = self.get_ports()
+		if ports != self.ports:
+			self.refresh_ports(None, self.treeview)
+			if self.detect:
+				self.detect_ports(None)
+		return True
+
+	@traced
+	def detect_ports(self, button):
+		""" Probes every port without a cached result at once, so detection takes about one probe timeout however many
+		adapters are attached.
+		"""
+		self.detect = True
+		timeout = self.app_window.config['DEFAULT'].getfloat('probe_timeout', 2)
+		for port, hwid in self.ports.items():
+			if port in self.probed or port in self.probing:	# cached until the port goes away, see forget_unplugged()
+				continue
+			self.probing.add(port)
+			self.show_probe(port)
+			Thread(target=self.probe_port, args=(port, hwid, self.app_window.ampy_args[1], timeout), daemon=True).start()
+
+	def probe_port(self, port, hwid, baud, timeout):
+		# On the port ampy-gui uses, wait for the device like any other operation would, but no longer than a probe
+		lock = self.app_window.device_lock if port == self.app_window.ampy_args[0] else None
+		try:
+			if lock is not None and self.app_window.capture is not None:
+				# Probing would interrupt the program whose output is captured
+				info = (None, "busy", None)
+			elif lock is not None and not lock.take(timeout):
+				info = (None, "busy", None)
+			else:
+				try:
+					with tracer.span("probe", "session", port=port):
+						info = probe_board(port, baud, timeout)
+				finally:
+					if lock is not None:
+						lock.release()
+		except PyboardError as ex:
+			info = (None, device_error_text(ex), None)
+		except (serial.SerialException, OSError) as ex:
+			info = (None, str(ex), None)
+		if info[1] != "busy":
+			self.probed[port] = (hwid, info)	# busy is not cached, the next Auto-detect tries again
+		self.probing.discard(port)
+		GLib.idle_add(self.show_probe, port, info)
+
+	def show_probe(self, port, info=None):
+		if self.treeview is None:
+			return
+		store = self.treeview.get_model()
+		iterator = store.get_iter_first()
+		while iterator is not None and store.get_value(iterator, self.PORT) != port:
+			iterator = store.iter_next(iterator)
+		if iterator is None:
+			return
+		if port in self.probing:
+			board, firmware, uid = "probing...", "", ""
+		elif info is not None or port in self.probed:
+			board, firmware, uid = info or self.probed[port][1]
+		else:
+			board, firmware, uid = "", "", ""
+		if board is None:
+			board, firmware = "-", "({})".format(firmware)
+		store.set(iterator, self.BOARD, board, self.FIRMWARE, firmware or "", self.ID, uid or "")
 
 	def on_response(self, widget, response_id):
 		selected = self.treeview.get_selection()
 		model, iterator = selected.get_selected()
 		if iterator:
-			self.result = model.get_value(iterator, 0)
+			self.result = model.get_value(iterator, self.PORT)
 		else:
 			self.result = None
 
+	def on_destroy(self, widget):
+		GLib.source_remove(self.hotplug_source)
+		self.treeview = None	# probes still running only cache their result, see show_probe()
+
 	def on_row_activated(self, treeview, path, column):
 		self.response(Gtk.ResponseType.OK)
 
@@ -1138,12 +4619,15 @@ class SelectPortPopUp(Gtk.Dialog):
 		return self.result
 
 	def get_ports(self):
+		""" OrderedDict of port -> hardware ID (USB VID:PID and serial number), which tells adapters on the same port
+		name apart.
+		"""
 		if sys.platform.startswith('darwin'):
-			return glob.glob('/dev/tty.*')
+			return OrderedDict((port, None) for port in sorted(glob.glob('/dev/tty.*')))
 		ports = serial.tools.list_ports.comports(include_links=True)
-		devices = []
+		devices = OrderedDict()
 		for port in sorted(ports):
-			devices.append(port.device)
+			devices[port.device] = port.hwid
 		return devices
 		
 class Application(Gtk.Application):
@@ -1175,8 +4659,10 @@ if __name__ == "__main__":
 	debug = False
 	use_timeout = True
 	timeout_delay = 120
+	benchmark_ports = []
+	trace_path = None
 	try:
-		opts, args = getopt.getopt(sys.argv[1:], "hdnt:", ["help", "debug", "notimeout", "timedelay="])
+		opts, args = getopt.getopt(sys.argv[1:], "hdnt:b:", ["help", "debug", "notimeout", "timedelay=", "benchmark=", "trace="])
 		for opt, arg in opts:
 			if opt in ['-h', '--help']:
 				print("Possible command line arguments:")
@@ -1186,6 +4672,10 @@ if __name__ == "__main__":
 					"\t-n or --notimeout : disables device connection timeout checking (if the device does not respond after a certain timeout delay, the connection is automatically broken).")
 				print(
 					"\t-t <timeout delay> or --timedelay <time delay> : specifies the timeout delay in seconds after which the device connection should be checked. Default delay is 120 seconds")
+				print(
+					"\t-b <port> or --benchmark <port> : measures latency and throughput to the device on port (a serial port or socket://host:port) and exits. Can be given several times to compare transports.")
+				print(
+					"\t--trace <file> : records the timing of every device operation and GUI event, and writes it to file in Chrome trace format on exit.")
 				sys.exit(2)
 			elif opt in ['-d', '--debug']:
 				debug = True
@@ -1196,11 +4686,38 @@ if __name__ == "__main__":
 					timeout_delay = int(arg)
 				except ValueError:
 					print("Wrong formatting of timeout delay, falling back to default delay")
+			elif opt in ['-b', '--benchmark']:
+				benchmark_ports.append(arg)
+			elif opt == '--trace':
+				trace_path = arg
+				tracer.enabled = True
 	except Exception as e:
 		print("Could not parse command line : {}".format(e))
 
+	if benchmark_ports:
+		# The baud rate and delay ampy-gui itself would use
+		config = configparser.ConfigParser()
+		config.read(os.path.join(os.getcwd(), os.path.dirname(__file__), 'config.ini'))
+		baud = config['DEFAULT'].get('baud', '115200')
+		delay = config['DEFAULT'].get('delay', '0')
+		print("{:<32} {:>10} {:>10} {:>14} {:>14}".format("port", "transport", "latency", "upload", "download"))
+		for port in benchmark_ports:
+			try:
+				latency, upload, download = benchmark_transport(port, baud, delay)
+			except (PyboardError, serial.SerialException) as ex:
+				print("{:<32} {:>10} {}".format(port, transport_for(port).name, device_error_text(ex)))
+				continue
+			print("{:<32} {:>10} {:>8.1f}ms {:>10.0f} B/s {:>10.0f} B/s".format(port, transport_for(port).name,
+																				  latency * 1000, upload, download))
+		if trace_path:
+			tracer.write(trace_path)
+		sys.exit(0)
+
 	app = Application()
 	app.debug = debug
 	app.use_timeout = use_timeout
 	app.timeout_delay = timeout_delay
 	app.run()
+	if trace_path:
+		tracer.write(trace_path)
+		print("Trace written to {}".format(trace_path))
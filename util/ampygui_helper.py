@@ -0,0 +1,356 @@
+"""
+Resident helper module for ampy-gui, installed on the remote device as /ampygui_helper.py.
+
+The host only sends one-line calls such as `_h.ls('/lib')`; every function prints its result as a single repr() line,
+which the host parses back into Python values.
+"""
+
+import sys
+try:
+	import os
+except ImportError:
+	import uos as os
+try:
+	import hashlib
+except ImportError:
+	import uhashlib as hashlib
+try:
+	import binascii
+except ImportError:
+	import ubinascii as binascii
+
+VERSION = 15
+
+_S_IFDIR = 0x4000
+_GEN = "/.ampygui_gen"	# counts the changes made through the helper, see stamp()
+_PART = ".ampygui-part"	# unfinished uploads, renamed to the real name once complete
+_buf = bytearray(512)
+
+
+def _path(path):
+	if not path:
+		return "/"
+	return path
+
+def _child(root, name):
+	# NOTE: os.path does not exist on micropython, hence this weird implementation
+	return "{}/{}".format(root.rstrip("/"), name)
+
+def _type(mode):
+	return "d" if mode & _S_IFDIR else "f"
+
+def _entries(path):
+	path = _path(path)
+	if hasattr(os, "ilistdir"):
+		for entry in os.ilistdir(path):
+			# (name, type, inode[, size]), size is missing on older ports
+			if entry[1] & _S_IFDIR:
+				yield entry[0], "d", 0
+			elif len(entry) > 3:
+				yield entry[0], "f", entry[3]
+			else:
+				yield entry[0], "f", os.stat(_child(path, entry[0]))[6]
+	else:
+		for name in os.listdir(path):
+			st = os.stat(_child(path, name))
+			yield name, _type(st[0]), st[6]
+
+def _listing(path):
+	# _entries() without the helper's own files
+	for entry in _entries(path):
+		if not entry[0].endswith(_PART) and _child(_path(path), entry[0]) != _GEN:
+			yield entry
+
+def _drop_part(path):
+	# The unfinished upload of a file that was written otherwise
+	try:
+		os.remove(path + _PART)
+	except OSError:
+		pass
+
+def _sha256(path, size=-1):
+	# Of the first size bytes, or of the whole file
+	h = hashlib.sha256()
+	mv = memoryview(_buf)
+	with open(path, "rb") as f:
+		while size:
+			n = f.readinto(mv if size < 0 or size >= len(_buf) else mv[:size])
+			if not n:
+				break
+			h.update(mv[:n])
+			size -= n if size > 0 else 0
+	return binascii.hexlify(h.digest()).decode()
+
+def _replace(tmp, path):
+	try:
+		os.rename(tmp, path)
+	except OSError:
+		# FAT does not rename over an existing file
+		os.remove(path)
+		os.rename(tmp, path)
+
+def _rm(path):
+	if os.stat(path)[0] & _S_IFDIR:
+		for name in os.listdir(path):
+			_rm(_child(path, name))
+		os.rmdir(path)
+	else:
+		os.remove(path)
+
+def _mkdir(path):
+	built = ""
+	for part in path.split("/"):
+		if not part:
+			continue
+		built += "/" + part
+		try:
+			os.mkdir(built)
+		except OSError:
+			if not os.stat(built)[0] & _S_IFDIR:
+				raise
+
+def _walk(path):
+	for name, kind, size in _listing(path):
+		child = _child(path, name)
+		yield child, kind, size
+		if kind == "d":
+			yield from _walk(child)
+
+def _changed():
+	gen = 0
+	try:
+		with open(_GEN) as f:
+			gen = int(f.read())
+	except (OSError, ValueError):
+		pass
+	with open(_GEN, "w") as f:
+		f.write(str(gen + 1))
+
+def _uid():
+	try:
+		import machine
+		return binascii.hexlify(machine.unique_id()).decode()
+	except (ImportError, AttributeError):
+		return None
+
+def ls(path=""):
+	""" [(name, 'd'|'f', size), ...] """
+	print(repr(list(_listing(path))))
+
+def stat(path):
+	""" ('d'|'f', size, mtime) """
+	st = os.stat(_path(path))
+	print(repr((_type(st[0]), st[6], st[8])))
+
+def sha(path, size=-1):
+	""" Hex sha256 of a file, or of its first size bytes """
+	print(repr(_sha256(path, size)))
+
+def part(path):
+	""" (size, hex sha256) of the unfinished upload of path, None if there is none """
+	try:
+		size = os.stat(path + _PART)[6]
+	except OSError:
+		print(repr(None))
+		return
+	print(repr((size, _sha256(path + _PART))))
+
+def rm(path):
+	""" rm -r """
+	_rm(path)
+	_drop_part(path)
+	_changed()
+	print(repr(True))
+
+def mkdir(path):
+	""" mkdir -p """
+	_mkdir(path)
+	_changed()
+	print(repr(True))
+
+def df(path="/"):
+	""" (total bytes, free bytes) """
+	st = os.statvfs(_path(path))
+	print(repr((st[1] * st[2], st[1] * st[3])))
+
+def uid():
+	""" Hex machine.unique_id(), or None when the port has none """
+	print(repr(_uid()))
+
+def echo(data):
+	""" (hex sha256 of data, data) """
+	print(repr((binascii.hexlify(hashlib.sha256(data).digest()).decode(), data)))
+
+def _stamp():
+	h = hashlib.sha256()
+	try:
+		with open(_GEN) as f:
+			h.update(f.read().encode())
+	except OSError:
+		pass
+	for entry in _listing("/"):
+		h.update("{}\t{}\t{}\n".format(*entry).encode())
+	h.update(str(os.statvfs("/")[3]).encode())
+	return binascii.hexlify(h.digest()).decode()
+
+def stamp():
+	""" Hex sha256 of the change counter, the root listing and the free blocks. Changes with every change made
+	through the helper, and with almost every other one, without walking the filesystem. """
+	print(repr(_stamp()))
+
+def cat(path, offset=0):
+	""" Streams a file, from offset on, as base64 lines """
+	mv = memoryview(_buf)
+	with open(path, "rb") as f:
+		f.seek(offset)
+		while True:
+			n = f.readinto(_buf)
+			if not n:
+				break
+			sys.stdout.write(binascii.b2a_base64(mv[:n]).decode())
+
+def find(path="/"):
+	""" (stamp(), [(path, 'd'|'f', size), ...]) of the whole tree below path, in one walk """
+	print(repr((_stamp(), list(_walk(_path(path))))))
+
+def _stdin():
+	stdin = getattr(sys.stdin, "buffer", None)
+	if stdin is None or not hasattr(stdin, "readinto"):
+		return None
+	try:
+		import micropython
+		micropython.kbd_intr(-1)	# 0x03 in the data must not raise KeyboardInterrupt, the raw REPL restores it
+	except (ImportError, AttributeError):
+		pass
+	return stdin
+
+def _chunks(stdin, size):
+	# Yields size raw bytes from stdin as slices of _buf, every chunk is requested from the host with \x06
+	mv = memoryview(_buf)
+	left = size
+	while left:
+		n = min(left, len(_buf))
+		sys.stdout.write("\x06")
+		got = 0
+		while got < n:
+			got += stdin.readinto(mv[got:n]) or 0
+		yield mv[:n]
+		left -= n
+
+def recv(path, size, offset=0, flush_every=16384):
+	""" Writes a file of size bytes to path, reading raw bytes from stdin. They go into path + _PART, which is renamed to
+	path once complete; with offset, the first offset bytes are already in there (see part()). Prints False,
+	without reading anything, when stdin can't be read raw on this port. """
+	stdin = _stdin()
+	if stdin is None:
+		print(repr(False))
+		return
+	unflushed = 0
+	with open(path + _PART, "ab" if offset else "wb") as f:
+		for chunk in _chunks(stdin, size - offset):
+			f.write(chunk)
+			unflushed += len(chunk)
+			if unflushed >= flush_every:
+				f.flush()
+				unflushed = 0
+	_replace(path + _PART, path)
+	_changed()
+	print(repr(True))
+
+def unpack(root, size):
+	""" Extracts size raw bytes from stdin below root: a "D 0 <path>\\n" or "F <size> <path>\\n" header per entry, every
+	file header followed by its data, which goes into path + _PART until it is complete. Prints False, without reading
+	anything, when stdin can't be read raw. """
+	stdin = _stdin()
+	if stdin is None:
+		print(repr(False))
+		return
+	header = b""
+	f = None
+	path = None
+	left = 0
+	try:
+		for chunk in _chunks(stdin, size):
+			i = 0
+			n = len(chunk)
+			while i < n:
+				if f is not None:
+					k = min(left, n - i)
+					f.write(chunk[i:i + k])
+					i += k
+					left -= k
+					if not left:
+						f.close()
+						f = None
+						_replace(path + _PART, path)
+					continue
+				rest = bytes(chunk[i:])
+				end = rest.find(b"\n")
+				if end < 0:
+					header += rest
+					break
+				header += rest[:end]
+				i += end + 1
+				kind, length, name = header.decode().split(" ", 2)
+				header = b""
+				path = _child(root, name)
+				if kind == "D":
+					_mkdir(path)
+				else:
+					left = int(length)
+					f = open(path + _PART, "wb")
+					if not left:
+						f.close()
+						f = None
+						_replace(path + _PART, path)
+	finally:
+		if f is not None:
+			f.close()
+		_changed()
+	print(repr(True))
+
+def sums(path):
+	""" The first 16 hex digits of the sha256 of every 512 byte block of a file, back to back. Nothing when the file
+	can't be read. """
+	try:
+		f = open(path, "rb")
+	except OSError:
+		return
+	mv = memoryview(_buf)
+	with f:
+		while True:
+			n = f.readinto(_buf)
+			if not n:
+				break
+			sys.stdout.write(binascii.hexlify(hashlib.sha256(mv[:n]).digest()[:8]).decode())
+
+def patch(path, size, ranges):
+	""" Rebuilds path as size bytes: the 512 byte blocks listed in ranges [[first, count], ...] are read raw from stdin,
+	the others are copied from the current file. The result is written next to path and renamed over it. Prints False,
+	without reading anything, when stdin can't be read raw. """
+	stdin = _stdin()
+	if stdin is None:
+		print(repr(False))
+		return
+	block = len(_buf)
+	total = 0
+	for first, count in ranges:
+		total += min((first + count) * block, size) - first * block
+	data = _chunks(stdin, total)
+	copy = bytearray(block)
+	mv = memoryview(copy)
+	tmp = path + _PART
+	with open(path, "rb") as old:
+		with open(tmp, "wb") as new:
+			done = 0
+			for first, count in ranges + [[(size + block - 1) // block, 0]]:
+				old.seek(done * block)
+				while done < first:
+					new.write(mv[:old.readinto(copy)])
+					done += 1
+				for i in range(count):
+					new.write(next(data))
+					done += 1
+	_replace(tmp, path)
+	_changed()
+	print(repr(True))